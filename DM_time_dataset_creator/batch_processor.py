@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dataset import ShardedDataset
+
+
+def available_memory_bytes():
+    """
+    Memory available for new processes, from /proc/meminfo.
+
+    Returns:
+        int or None: `MemAvailable` in bytes, or None where /proc/meminfo is not available.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _process_observation(config_path):
+    """
+    Create the dataset of one observation; runs in a worker process.
+
+    Args:
+        config_path (str): Path to the configuration of the observation.
+
+    Returns:
+        str: Path to the JSON manifest of the dataset.
+    """
+    # Imported here, so the parent process does not need `your` to plan the batch
+    from processor import DMTimeDataSetCreator
+    return DMTimeDataSetCreator(config_path).process()
+
+
+class BatchDataSetCreator:
+    """
+    Creates the DM-Time datasets of many observations in parallel and merges them into one corpus.
+
+    The batch is described by a JSON manifest:
+
+        {
+            "corpus_name": "crab_corpus",
+            "base_config": "config.json",
+            "max_workers": 4,
+            "memory_per_worker_gb": 4,
+            "observations": [
+                {"filterbank_path": "...", "transientx_time_series_path": "...", "transientx_candidates_path": "..."},
+                ...
+            ]
+        }
+
+    Every observation is the base configuration updated with the keys of its entry. The
+    observations are processed by `DMTimeDataSetCreator` in a pool of worker processes, and
+    the number of workers is limited by `max_workers`, the number of CPUs and the memory
+    available for `memory_per_worker_gb` per worker.
+
+    The corpus is a manifest readable by `dataset.ShardedDataset` that references the shards of
+    all observations in place, with a new permutation over all of their samples and the
+    provenance of every observation, so no sample is copied to build it.
+
+    Attributes:
+        manifest (dict): Content of the batch manifest.
+        base_config (dict): Configuration shared by all observations.
+        corpus_name (str): Base name of the corpus files.
+        output_dir (str): Directory of the per-observation outputs and of the corpus.
+        config_dir (str): Directory of the generated per-observation configurations.
+        rng (numpy.random.Generator): Random generator of the corpus permutation, seeded by the optional `seed`.
+    """
+    def __init__(self, manifest_path):
+        """
+        Initialize the batch with the given manifest file.
+
+        Args:
+            manifest_path (str): Path to the JSON batch manifest.
+        """
+        with open(manifest_path, 'r') as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+        self.base_config = {}
+        if "base_config" in self.manifest:
+            with open(self.manifest["base_config"], 'r') as config_file:
+                self.base_config = json.load(config_file)
+
+        self.corpus_name = self.manifest.get("corpus_name", "corpus")
+        self.output_dir = os.path.join(os.getcwd(), 'outputs')
+        self.config_dir = os.path.join(self.output_dir, 'configs')
+        self.rng = np.random.default_rng(self.manifest.get("seed", self.base_config.get("seed")))
+        os.makedirs(self.config_dir, exist_ok=True)
+
+    def _worker_count(self):
+        """
+        Number of observations processed at the same time.
+
+        Returns:
+            int: Number of workers allowed by `max_workers`, the CPUs and the available memory.
+        """
+        n_observations = len(self.manifest["observations"])
+        workers = min(self.manifest.get("max_workers", os.cpu_count() or 1), os.cpu_count() or 1, n_observations)
+
+        memory = available_memory_bytes()
+        memory_per_worker = self.manifest.get("memory_per_worker_gb", 4) * 1024 ** 3
+        if memory is not None:
+            workers = min(workers, int(memory // memory_per_worker))
+        return max(1, workers)
+
+    def _write_observation_configs(self, workers):
+        """
+        Write the configuration of every observation.
+
+        The ingest threads of the configurations that do not set `ingest_workers` are
+        shared between the workers, so the pool does not oversubscribe the CPUs.
+
+        The observations write their outputs side by side, so every one is given its own
+        `dataset_name`, the filterbank name prefixed with its position in the manifest,
+        unless its entry sets one.
+
+        Args:
+            workers (int): Number of workers of the pool.
+
+        Returns:
+            list: Paths to the configurations, in manifest order.
+
+        Raises:
+            ValueError: If two observations have the same `dataset_name`.
+        """
+        config_paths, dataset_names = [], set()
+        for idx, observation in enumerate(self.manifest["observations"]):
+            config = {**self.base_config, **observation}
+            if "ingest_workers" not in observation:
+                config["ingest_workers"] = max(1, self.base_config.get("ingest_workers", 16) // workers)
+
+            name = os.path.splitext(os.path.basename(config["filterbank_path"]))[0]
+            if "dataset_name" not in observation:
+                config["dataset_name"] = f'{idx:04d}_{name}'
+            if config["dataset_name"] in dataset_names:
+                raise ValueError(f"Observation {idx} has the dataset_name {config['dataset_name']} of an earlier observation")
+            dataset_names.add(config["dataset_name"])
+
+            config_path = os.path.join(self.config_dir, f'{idx:04d}_{name}.json')
+            with open(config_path, 'w') as config_file:
+                json.dump(config, config_file, indent=4)
+            config_paths.append(config_path)
+        return config_paths
+
+    def process(self):
+        """
+        Create the datasets of all observations and merge them into the corpus.
+
+        Returns:
+            str: Path to the JSON manifest of the corpus.
+        """
+        workers = self._worker_count()
+        config_paths = self._write_observation_configs(workers)
+        print(f'Processing {len(config_paths)} observations with {workers} workers')
+
+        # Spawn fresh workers, so they do not inherit the threads and file handles of the parent
+        manifest_paths = [None] * len(config_paths)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = {executor.submit(_process_observation, path): idx for idx, path in enumerate(config_paths)}
+            for future in as_completed(futures):
+                idx = futures[future]
+                manifest_paths[idx] = future.result()
+                print(f'Finished {os.path.basename(manifest_paths[idx])}')
+
+        return self._merge(config_paths, manifest_paths)
+
+    def _merge(self, config_paths, manifest_paths):
+        """
+        Write the corpus manifest referencing the shards of all observations.
+
+        Only the permutation and the labels of the corpus are written; they hold one
+        entry per sample, while the samples stay in the shards of the observations.
+
+        Args:
+            config_paths (list): Configurations of the observations, in manifest order.
+            manifest_paths (list): Dataset manifests of the observations, in the same order.
+
+        Returns:
+            str: Path to the JSON manifest of the corpus.
+
+        Raises:
+            ValueError: If the observations have different sample shapes.
+        """
+        base_name = f'{self.corpus_name}_DM_time_corpus'
+        shards, observations, shard_labels = [], [], []
+        sample_shape = None
+        first_sample = 0
+
+        for config_path, manifest_path in zip(config_paths, manifest_paths):
+            dataset = ShardedDataset(manifest_path)
+            if sample_shape is None:
+                sample_shape = dataset.sample_shape
+            elif dataset.sample_shape != sample_shape:
+                raise ValueError(
+                    f"Sample shape {dataset.sample_shape} of {manifest_path} differs from the corpus sample shape {sample_shape}"
+                )
+
+            manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+            for shard in dataset.manifest['shards']:
+                path = os.path.relpath(os.path.join(manifest_dir, shard['path']), self.output_dir)
+                shard = {**shard, 'path': path, 'observation': dataset.manifest['name']}
+                if shard.get('kind') == 'positions':
+                    # Every observation has its own cube, referenced by its shards
+                    cube = shard.get('cube', dataset.manifest.get('cube'))
+                    shard['cube'] = os.path.relpath(os.path.join(manifest_dir, cube), self.output_dir)
+                shards.append(shard)
+                shard_labels.append((shard['label'], shard['count'] * shard.get('samples_per_record', 1)))
+
+            with open(config_path, 'r') as config_file:
+                config = json.load(config_file)
+            observations.append({
+                'name': dataset.manifest['name'],
+                'manifest': os.path.relpath(manifest_path, self.output_dir),
+                'filterbank_path': config['filterbank_path'],
+                'transientx_candidates_path': config['transientx_candidates_path'],
+                'config': config,
+                'first_sample': first_sample,
+                'n_samples': len(dataset)
+            })
+            first_sample += len(dataset)
+
+        # Labels of the samples of all shards concatenated in order
+        labels = np.repeat([label for label, _ in shard_labels], [count for _, count in shard_labels])
+
+        # Shuffle by index only; the permutation is applied when the samples are read
+        indices = self.rng.permutation(len(labels))
+        np.save(os.path.join(self.output_dir, f'{base_name}_index.npy'), indices)
+        np.save(os.path.join(self.output_dir, f'{base_name}_labels.npy'), labels[indices])
+
+        corpus = {
+            'name': self.corpus_name,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'sample_shape': list(sample_shape),
+            'observations': observations,
+            'shards': shards,
+            'index': f'{base_name}_index.npy',
+            'labels': f'{base_name}_labels.npy'
+        }
+        corpus_path = os.path.join(self.output_dir, f'{base_name}.json')
+        with open(corpus_path, 'w') as corpus_file:
+            json.dump(corpus, corpus_file, indent=4)
+        print(f'Corpus of {len(labels)} samples written to {corpus_path}')
+        return corpus_path
+
+
+if __name__ == "__main__":
+    # Usage: python batch_processor.py <batch_manifest.json>
+    BatchDataSetCreator(sys.argv[1]).process()
@@ -0,0 +1,143 @@
+import os
+import json
+import uuid
+import fcntl
+import hashlib
+import numpy as np
+
+
+def file_fingerprint(path, head_size=1 << 16, block_size=1 << 12, n_blocks=32):
+    """
+    Content fingerprint of a large input file: its size and the SHA-256 of sampled parts of it.
+
+    Reading whole filterbank or .dat files to hash them would cost as much as
+    using them, so only the first `head_size` bytes (which hold the header),
+    the last `block_size` bytes and `n_blocks` evenly spaced blocks in between
+    are hashed; files no larger than these samples are hashed whole. The path
+    and modification time are left out, so touching, copying or moving a file
+    keeps its products, while rewriting its header or the sampled data
+    invalidates them. A rewrite that keeps the size and changes only bytes
+    between the samples is not detected.
+
+    Args:
+        path (str): Path to the file.
+        head_size (int): Number of bytes hashed from the start of the file.
+        block_size (int): Number of bytes of every sampled block.
+        n_blocks (int): Number of blocks sampled between the head and the end.
+
+    Returns:
+        dict: Size in bytes and hex digest of the sampled content.
+    """
+    size = os.path.getsize(path)
+    if size <= head_size + (n_blocks + 1) * block_size:
+        return {'size': size, 'sha256': file_digest(path)}
+
+    digest = hashlib.sha256()
+    offsets = np.linspace(head_size, size - block_size, n_blocks + 1).astype(np.int64)
+    with open(path, 'rb') as file:
+        digest.update(file.read(head_size))
+        for offset in offsets:
+            file.seek(offset)
+            digest.update(file.read(block_size))
+    return {'size': size, 'sha256': digest.hexdigest()}
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    SHA-256 of the content of a small input file, such as a candidate list.
+
+    Args:
+        path (str): Path to the file.
+        chunk_size (int): Number of bytes hashed at a time.
+
+    Returns:
+        str: Hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Content-addressed store of the intermediate products of dataset creation.
+
+    Every product is a .npy file named after its stage and the key of its
+    inputs, `<cache_dir>/<stage>_<key>.npy`. A product is only created when
+    no file with its key exists, so a stage is recomputed exactly when one of
+    its inputs changes. Products are written under a temporary name and
+    renamed once complete, so an interrupted run never leaves a truncated
+    product behind. Processes sharing the cache, such as the workers of a
+    batch, create a product one at a time under an exclusive lock on
+    `<product>.lock`; the others wait and then use the finished product.
+    Outdated products are not removed; delete the cache directory to
+    reclaim their space.
+
+    Attributes:
+        cache_dir (str): Directory of the cached products.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(**inputs):
+        """
+        Key of a product, the hash of everything it is computed from.
+
+        Args:
+            **inputs: JSON-serialisable inputs of the stage, including the keys of
+                the products it depends on.
+
+        Returns:
+            str: Hex key of the inputs.
+        """
+        serialized = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()[:24]
+
+    def path(self, stage, key):
+        """
+        Path of the product of `stage` with the given key.
+        """
+        return os.path.join(self.cache_dir, f'{stage}_{key}.npy')
+
+    def get_or_create(self, stage, key, create):
+        """
+        Get the path of a product, creating it first if it is not cached.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Key of the inputs of the product.
+            create (callable): Called with a temporary .npy path to write the product to.
+
+        Returns:
+            str: Path of the cached product.
+        """
+        path = self.path(stage, key)
+        if os.path.exists(path):
+            print(f'Using cached {stage} {key}')
+            return path
+
+        with open(f'{path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Another process may have created the product while this one waited for the lock
+            if os.path.exists(path):
+                print(f'Using cached {stage} {key}')
+                return path
+
+            # Every writer has its own temporary file, so no writer truncates another's
+            tmp_path = f'{path}.{os.getpid()}_{uuid.uuid4().hex}.tmp.npy'
+            try:
+                create(tmp_path)
+                if os.path.exists(path):
+                    os.remove(tmp_path)
+                else:
+                    os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return path
@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import numpy as np
+from tqdm import tqdm
+
+PIPELINE_CLASSIFIER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline_classifier')
+sys.path.insert(0, PIPELINE_CLASSIFIER_DIR)
+import preprocessing  # noqa: E402
+
+
+def normalize_images_to_255(images):
+    """
+    Normalize a batch of 2D images to the 0-255 range, each by its own minimum and maximum.
+
+    Delegates to `preprocessing.normalize` of the inference pipeline, so the
+    training data is normalised exactly like the pages classified online.
+
+    Args:
+        images (numpy.ndarray): Batch of images of shape (n_images, height, width).
+
+    Returns:
+        numpy.ndarray: Normalized images scaled to 0-255 as uint8.
+    """
+    return preprocessing.normalize(images)
+
+
+def crop_windows(strips, shifts, width=256):
+    """
+    Crop shifted windows out of DM-Time strips and normalise them.
+
+    A strip of a candidate covers `ntsamples + width - 1` time samples, and
+    shift `i` is the window ending `i` samples after the end of the first
+    window, so shift `i` of a strip is `strip[:, ntsamples - 1 - i:ntsamples - 1 - i + width]`,
+    the window `DMTimeDataSetCreator` used to materialise as sample `i` of the candidate.
+
+    Args:
+        strips (numpy.ndarray): Strips of shape (n, number of DMs, ntsamples + width - 1).
+        shifts (array-like): Shift of every strip, in [0, ntsamples).
+        width (int): Number of time samples of a window.
+
+    Returns:
+        numpy.ndarray: uint8 windows of shape (n, number of DMs, width).
+    """
+    ntsamples = strips.shape[2] - width + 1
+    starts = ntsamples - 1 - np.asarray(shifts)
+    columns = starts[:, np.newaxis] + np.arange(width)
+    windows = np.take_along_axis(strips, columns[:, np.newaxis, :], axis=2)
+    return normalize_images_to_255(windows)
+
+
+def crop_cube_windows(cube, positions, width=256):
+    """
+    Crop windows out of a DM-Time cube, flip their DM axis and normalise them.
+
+    Window `i` starts at time sample `positions[i]` of the cube; this is how
+    `DMTimeDataSetCreator` samples the 'rest of events' category.
+
+    Args:
+        cube (numpy.ndarray): DM-Time cube of shape (number of DMs, number of time samples).
+        positions (array-like): Start sample of every window.
+        width (int): Number of time samples of a window.
+
+    Returns:
+        numpy.ndarray: uint8 windows of shape (n, number of DMs, width).
+    """
+    columns = np.asarray(positions)[:, np.newaxis] + np.arange(width)
+    # Gather the flipped windows as (window, DM, time) and normalise them together
+    windows = cube[::-1][:, columns]
+    return normalize_images_to_255(windows.transpose(1, 0, 2))
+
+
+class ShardedDataset:
+    """
+    Lazy reader of a DM-Time dataset written by `DMTimeDataSetCreator`.
+
+    The dataset is described by a JSON manifest listing one `.npy` shard per
+    category, a permutation index and the shuffled labels. The shards are
+    memory-mapped and the permutation is applied on access, so sample `i` of
+    the dataset is sample `index[i]` of the shards concatenated in manifest
+    order. Nothing is loaded into memory until it is read.
+
+    Shards of kind "windows" hold one normalised uint8 sample per record.
+    Shards of kind "strips" hold one float32 strip per candidate, which
+    stands for `samples_per_record` time-shifted samples; these are cropped
+    and normalised when they are read (see `crop_windows`). Shards of kind
+    "positions" hold the int64 start sample of every window in the float32
+    DM-Time cube named by `cube` in the manifest (or in the shard entry), and
+    the windows are cropped from the memory-mapped cube when they are read
+    (see `crop_cube_windows`).
+
+    Attributes:
+        manifest (dict): Content of the manifest file.
+        shards (list): Memory-mapped shards in manifest order.
+        cubes (list): Memory-mapped DM-Time cube of every "positions" shard, None for the other shards.
+        samples_per_record (numpy.ndarray): Number of samples stored in one record of every shard.
+        offsets (numpy.ndarray): Index of the first sample of every shard in the concatenation.
+        index (numpy.ndarray): Memory-mapped permutation of the concatenated samples.
+        labels (numpy.ndarray): Memory-mapped labels in the shuffled order.
+    """
+    def __init__(self, manifest_path):
+        """
+        Open the dataset described by a manifest file.
+
+        Args:
+            manifest_path (str): Path to the JSON manifest.
+        """
+        with open(manifest_path, 'r') as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+        base_dir = os.path.dirname(os.path.abspath(manifest_path))
+        self.shards = [np.load(os.path.join(base_dir, shard['path']), mmap_mode='r') for shard in self.manifest['shards']]
+
+        # Shards of one observation share its cube, which is mapped only once
+        cubes = {}
+        self.cubes = []
+        for shard in self.manifest['shards']:
+            cube_path = None
+            if shard.get('kind') == 'positions':
+                cube_path = os.path.normpath(os.path.join(base_dir, shard.get('cube', self.manifest.get('cube'))))
+                if cube_path not in cubes:
+                    cubes[cube_path] = np.load(cube_path, mmap_mode='r')
+            self.cubes.append(cubes.get(cube_path))
+
+        # Manifests written before strips were introduced only have windows
+        self.samples_per_record = np.array([shard.get('samples_per_record', 1) for shard in self.manifest['shards']])
+        self.offsets = np.concatenate(([0], np.cumsum([len(shard) for shard in self.shards] * self.samples_per_record)))
+        self.index = np.load(os.path.join(base_dir, self.manifest['index']), mmap_mode='r')
+        self.labels = np.load(os.path.join(base_dir, self.manifest['labels']), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def sample_shape(self):
+        return tuple(self.manifest['sample_shape'])
+
+    def __getitem__(self, item):
+        """
+        Read samples of the shuffled dataset.
+
+        Args:
+            item (int, slice or array-like): Positions in the shuffled dataset.
+
+        Returns:
+            numpy.ndarray: A single uint8 sample for an integer, otherwise a batch of samples.
+        """
+        if np.isscalar(item):
+            return self.get_batch([item])[0]
+        return self.get_batch(np.arange(len(self))[item] if isinstance(item, slice) else item)
+
+    def get_batch(self, positions):
+        """
+        Read a batch of samples of the shuffled dataset.
+
+        Args:
+            positions (array-like): Positions in the shuffled dataset.
+
+        Returns:
+            numpy.ndarray: uint8 array of shape (len(positions), *sample_shape).
+        """
+        samples = np.asarray(self.index[np.asarray(positions)])
+        batch = np.empty((len(samples), *self.sample_shape), dtype=np.uint8)
+        shard_ids = np.searchsorted(self.offsets, samples, side='right') - 1
+
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            records, shifts = np.divmod(samples[mask] - self.offsets[shard_id], self.samples_per_record[shard_id])
+
+            # Read in storage order for locality, then put the samples back in place
+            order = np.argsort(records)
+            rows = np.empty_like(records)
+            rows[order] = np.arange(len(records))
+            data = self.shards[shard_id][records[order]]
+            kind = self.manifest['shards'][shard_id].get('kind', 'windows')
+            if kind == 'strips':
+                data = crop_windows(data, shifts[order], width=self.sample_shape[1])
+            elif kind == 'positions':
+                data = crop_cube_windows(self.cubes[shard_id], data, width=self.sample_shape[1])
+            batch[mask] = data[rows]
+
+        return batch
+
+    def save_npy(self, path, chunk_size=4096):
+        """
+        Write the shuffled samples to a single .npy file, chunk by chunk.
+
+        Only meant for consumers that need one flat array; the file is written
+        through a memory map, so memory usage stays at one chunk.
+
+        Args:
+            path (str): Output .npy file.
+            chunk_size (int): Number of samples copied at a time.
+        """
+        output = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(len(self), *self.sample_shape))
+        for start in tqdm(range(0, len(self), chunk_size), desc='Writing samples'):
+            stop = min(start + chunk_size, len(self))
+            output[start:stop] = self.get_batch(np.arange(start, stop))
+        output.flush()
+
+
+if __name__ == "__main__":
+    # Usage: python dataset.py <manifest.json> <output.npy>
+    ShardedDataset(sys.argv[1]).save_npy(sys.argv[2])
@@ -0,0 +1,159 @@
+import json
+import numpy as np
+from tqdm import tqdm
+
+# Dispersion constant in s MHz^2 pc^-1 cm^3
+DISPERSION_CONSTANT = 4.148808e3
+
+
+def dispersion_delay(dm, freqs, reference_freq):
+    """
+    Dispersion delay of `freqs` relative to `reference_freq`.
+
+    Args:
+        dm (float or numpy.ndarray): Dispersion measure in pc cm^-3.
+        freqs (float or numpy.ndarray): Frequencies in MHz.
+        reference_freq (float or numpy.ndarray): Reference frequency in MHz.
+
+    Returns:
+        numpy.ndarray: Delays in seconds, broadcast over the arguments.
+    """
+    freqs = np.asarray(freqs, dtype=np.float64)
+    reference_freq = np.asarray(reference_freq, dtype=np.float64)
+    return DISPERSION_CONSTANT * np.asarray(dm, dtype=np.float64) * (freqs ** -2.0 - reference_freq ** -2.0)
+
+
+def load_dm_grid(dedispersion_config_path):
+    """
+    Read the DM grid of the `subdedispersion` section of a TransientX configuration.
+
+    Args:
+        dedispersion_config_path (str): Path to `dbdedispdb_config.json`.
+
+    Returns:
+        numpy.ndarray: `ndm` DM trials starting at `dms` in steps of `ddm`.
+    """
+    with open(dedispersion_config_path, 'r') as file:
+        config = json.load(file)["subdedispersion"]
+    return config["dms"] + config["ddm"] * np.arange(config["ndm"])
+
+
+class SubbandDedisperser:
+    """
+    Two-stage subband dedispersion of filterbank blocks over a DM grid.
+
+    The channels are split into `nsub` subbands. In the first stage the
+    channels of every subband are summed at a few nominal DMs, one per group
+    of neighbouring DM trials; the groups are as wide as possible while the
+    delay error inside a subband stays below half a sample. In the second
+    stage the subbands are shifted to every DM trial of their group and
+    summed. Every shift is a slice of the time axis, so no data is copied
+    besides the sums, and the cost per sample is about `nchans * n_groups + nsub * ndm` additions instead of
+    `nchans * ndm` for brute-force dedispersion.
+
+    The dedispersed time series are referenced to the highest frequency:
+    sample `t` of a DM trial sums the channels at `t` plus their delay.
+
+    Only dedispersion is performed: unlike `dada_dbdedispdb`, no RFI
+    mitigation (`rfi`, including `zaplist`), `preprocesslite` zapping,
+    downsampling or baseline removal is applied to the channels, so the
+    cubes it makes are not the pages the inference pipeline classifies
+    wherever those steps would have changed the data.
+
+    Attributes:
+        dms (numpy.ndarray): DM trials, in the order of the output rows.
+        overlap (int): Extra samples a block needs beyond the samples it
+            produces, at least the maximum dispersion delay of the grid.
+    """
+    def __init__(self, freqs, tsamp, dms, nsub=64):
+        """
+        Args:
+            freqs (numpy.ndarray): Centre frequency of every channel in MHz, in channel order.
+            tsamp (float): Sampling time in seconds.
+            dms (numpy.ndarray): DM trials in pc cm^-3.
+            nsub (int): Number of subbands.
+        """
+        freqs = np.asarray(freqs, dtype=np.float64)
+        self.dms = np.asarray(dms, dtype=np.float64)
+        self.nchans = len(freqs)
+        self.nsub = min(nsub, self.nchans)
+        self.subband_of_channel = np.arange(self.nchans) * self.nsub // self.nchans
+
+        subband_top = np.array([freqs[self.subband_of_channel == s].max() for s in range(self.nsub)])
+        subband_bottom = np.array([freqs[self.subband_of_channel == s].min() for s in range(self.nsub)])
+
+        # Largest group of DM trials whose delays inside a subband stay within half a sample of the nominal DM
+        delay_per_dm = np.max(dispersion_delay(1.0, subband_bottom, subband_top)) / tsamp
+        dm_step = np.min(np.diff(self.dms)) if len(self.dms) > 1 else 0.0
+        if dm_step > 0 and delay_per_dm > 0:
+            group_size = int(np.clip(int(1.0 / (dm_step * delay_per_dm)) + 1, 1, len(self.dms)))
+        else:
+            group_size = len(self.dms)
+        self.group_of_dm = np.arange(len(self.dms)) // group_size
+        self.n_groups = self.group_of_dm[-1] + 1
+        nominal_dms = np.array([self.dms[self.group_of_dm == k].mean() for k in range(self.n_groups)])
+
+        # (n_groups, nchans) delays of the channels relative to the top of their subband
+        self.channel_delays = np.rint(
+            dispersion_delay(nominal_dms[:, np.newaxis], freqs, subband_top[self.subband_of_channel]) / tsamp
+        ).astype(np.int64)
+        # (ndm, nsub) delays of the tops of the subbands relative to the highest frequency
+        self.subband_delays = np.rint(
+            dispersion_delay(self.dms[:, np.newaxis], subband_top, freqs.max()) / tsamp
+        ).astype(np.int64)
+
+        # Cover both the delays used by the two stages and the full dispersion delay of the grid
+        max_delay = np.ceil(np.max(dispersion_delay(self.dms.max(), freqs, freqs.max())) / tsamp)
+        self.overlap = int(max(self.channel_delays.max() + self.subband_delays.max(), max_delay))
+
+    def dedisperse(self, block):
+        """
+        Dedisperse a block of channels.
+
+        Args:
+            block (numpy.ndarray): float32 array of shape (nchans, n + overlap).
+
+        Returns:
+            numpy.ndarray: float32 array of shape (number of DM trials, n).
+        """
+        n_out = block.shape[1] - self.overlap
+        subband_length = n_out + int(self.subband_delays.max())
+
+        # First stage: channels to subbands at the nominal DMs
+        subbands = np.zeros((self.n_groups, self.nsub, subband_length), dtype=np.float32)
+        for group in range(self.n_groups):
+            for channel, delay in enumerate(self.channel_delays[group]):
+                subbands[group, self.subband_of_channel[channel]] += block[channel, delay:delay + subband_length]
+
+        # Second stage: subbands to the DM trials of every group
+        output = np.zeros((len(self.dms), n_out), dtype=np.float32)
+        for dm_idx, group in enumerate(self.group_of_dm):
+            for subband, delay in enumerate(self.subband_delays[dm_idx]):
+                output[dm_idx] += subbands[group, subband, delay:delay + n_out]
+
+        return output
+
+
+def dedisperse_filterbank(filterbank_file, dedisperser, output, chunk_size=16384):
+    """
+    Dedisperse a filterbank file chunk by chunk into the rows of `output`.
+
+    Consecutive chunks overlap by `dedisperser.overlap` samples, so every
+    output sample sees all of its delayed channels. Only one chunk of the
+    filterbank is held in memory at a time.
+
+    Args:
+        filterbank_file (your.Your): Opened filterbank file.
+        dedisperser (SubbandDedisperser): Dedisperser for the channels of the file.
+        output (numpy.ndarray): Writable array of shape (number of DM trials, nspectra - overlap),
+            typically a memory map of the DM-Time cube.
+        chunk_size (int): Number of output samples per chunk.
+    """
+    n_out = output.shape[1]
+    with tqdm(total=n_out, unit='samples', desc='Dedispersing') as pbar:
+        for start in range(0, n_out, chunk_size):
+            n = min(chunk_size, n_out - start)
+            spectra = filterbank_file.get_data(nstart=start, nsamp=n + dedisperser.overlap)
+            block = np.ascontiguousarray(spectra.T, dtype=np.float32)
+            output[:, start:start + n] = dedisperser.dedisperse(block)
+            pbar.update(n)
@@ -3,10 +3,61 @@ import glob
 import numpy as np
 import pandas as pd
 import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from decimal import Decimal
 from tqdm import tqdm
 import your
 
+from dataset import crop_cube_windows, normalize_images_to_255
+from dedispersion import SubbandDedisperser, dedisperse_filterbank, load_dm_grid
+from cache import StageCache, file_digest, file_fingerprint
+
+# TransientX configuration of the inference pipeline, the default DM grid of the 'native' backend
+DEFAULT_DEDISPERSION_CONFIG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline_classifier', 'dbdedispdb_config.json'
+)
+
+
+def _read_file_into(path, buffer):
+    """
+    Read the whole binary file at `path` into the writable `buffer` without
+    intermediate copies.
+
+    Args:
+        path (str): Path to the file.
+        buffer (numpy.ndarray): Contiguous array with exactly the size of the file.
+
+    Returns:
+        int: Number of bytes read.
+    """
+    view = memoryview(buffer).cast('B')
+    with open(path, 'rb', buffering=0) as file:
+        n_read = 0
+        while n_read < len(view):
+            chunk = file.readinto(view[n_read:])
+            if not chunk:
+                raise IOError(f"Unexpected end of file in {path}")
+            n_read += chunk
+    return n_read
+
+
+def _read_dat_into_cache_row(cache_path, row, path):
+    """
+    Process-pool worker: read one .dat file into its row of the .npy cache.
+
+    Args:
+        cache_path (str): Path to the .npy memory map being built.
+        row (int): Row of the cube that belongs to the file.
+        path (str): Path to the .dat file.
+
+    Returns:
+        int: Number of bytes read.
+    """
+    dm_time_image = np.load(cache_path, mmap_mode='r+')
+    n_read = _read_file_into(path, dm_time_image[row])
+    dm_time_image.flush()
+    return n_read
+
 
 class DMTimeDataSetCreator:
     """
@@ -19,8 +70,22 @@ class DMTimeDataSetCreator:
         transient_x_cands_path (str): Path to the file containing list of candidates.
         dm_ranges (dict): Left and right edges of DM range.
         ntsamples (int): Number of time samples for each candidate.
+        store_strips (bool): Store one float32 DM-Time strip per pulse or zero DM candidate instead of
+            its `ntsamples` shifted windows, and only the positions of the 'rest' windows in the cube;
+            the windows are cropped from the strip or the cube when read.
+        rng (numpy.random.Generator): Random generator for sampling the 'rest' category, seeded by the optional `seed`.
+        shuffle_rng (numpy.random.Generator): Independent random generator of the shuffling permutation, so the
+            permutation does not depend on whether the 'rest' category was sampled or taken from the cache.
+        ingest_workers (int): Number of concurrent readers of the .dat files.
+        ingest_backend (str): 'thread' or 'process' parallelism for reading the .dat files.
+        dedispersion_backend (str): 'transientx' to read the cube from the TransientX .dat files, or
+            'native' to dedisperse the filterbank file directly.
+        dedisperser (SubbandDedisperser): Dedisperser of the 'native' backend, None otherwise.
         output_dir (str): Directory to store the output dataset and labels.
-        name_of_set (str): Base name of the dataset based on the filterbank file name.
+        name_of_set (str): Base name of the dataset, `dataset_name` or else the filterbank file name.
+        cache (StageCache): Content-addressed cache of the intermediate products, in `cache_dir`.
+        dm_time_cube_key (str): Cache key of the DM-time cube.
+        dm_time_image (numpy.memmap): Read-only float32 DM-time cube mapped from the on-disk cache.
     """
     def __init__(self, config_path):
         """
@@ -39,17 +104,32 @@ class DMTimeDataSetCreator:
         self.transient_x_cands_path = self.config["transientx_candidates_path"]
         self.dm_ranges = self.config["dm_ranges"]
         self.ntsamples = self.config["ntsamples"]
+        self.store_strips = self.config.get("store_strips", True)
+        sampling_seed, shuffle_seed = np.random.SeedSequence(self.config.get("seed")).spawn(2)
+        self.rng = np.random.default_rng(sampling_seed)
+        self.shuffle_rng = np.random.default_rng(shuffle_seed)
+        self.ingest_workers = self.config.get("ingest_workers", 16)
+        self.ingest_backend = self.config.get("ingest_backend", "thread")
         self.output_dir = os.path.join(os.getcwd(), 'outputs')
-        self.name_of_set = self.filterbank_file.your_header.basename
+        self.name_of_set = self.config.get("dataset_name", self.filterbank_file.your_header.basename)
 
         # Ensure output directory exists
         os.makedirs(self.output_dir, exist_ok=True)
+        self.cache = StageCache(self.config.get("cache_dir", os.path.join(self.output_dir, 'cache')))
 
         # Prepare file list and DMs
-        self.file_list, self.dm_list = self._prepare_file_list_and_dm()
+        self.dedispersion_backend = self.config.get("dedispersion_backend", "transientx")
+        self.dedisperser = None
+        if self.dedispersion_backend == 'native':
+            self.dedisperser = self._create_dedisperser()
+            self.file_list, self.dm_list = [], list(self.dedisperser.dms)
+        elif self.dedispersion_backend == 'transientx':
+            self.file_list, self.dm_list = self._prepare_file_list_and_dm()
+        else:
+            raise ValueError(f"Unknown dedispersion backend: {self.dedispersion_backend}")
 
-        # Load DM-time image
-        self.dm_time_image = self._create_dm_time_image()
+        # Open the DM-time image, building its on-disk cache on the first run
+        self.dm_time_image = self._load_dm_time_image()
 
     @staticmethod
     def normalize_image_to_255(image):
@@ -62,9 +142,16 @@ class DMTimeDataSetCreator:
         Returns:
             numpy.ndarray: Normalized image scaled to 0-255 as uint8.
         """
-        image = image.astype(np.float32)
-        normalized_image = (image - np.min(image)) / (np.max(image) - np.min(image))
-        return (normalized_image * 255).astype(np.uint8)
+        return normalize_images_to_255(image)
+
+    @staticmethod
+    def normalize_images_to_255(images):
+        """
+        Normalize a batch of 2D images to the 0-255 range, each by its own minimum and maximum.
+
+        See `dataset.normalize_images_to_255`, which is shared with the dataset reader.
+        """
+        return normalize_images_to_255(images)
 
     def _prepare_file_list_and_dm(self):
         """
@@ -80,20 +167,143 @@ class DMTimeDataSetCreator:
         dms = [float(os.path.basename(i).split('DM')[1].split('.dat')[0]) for i in flist]
         return flist, dms
 
-    def _create_dm_time_image(self):
+    def _create_dedisperser(self):
         """
-        Create the DM-Time image from the list of .dat files.
+        Create the dedisperser of the 'native' backend for the channels of the filterbank file.
+
+        The DM grid is read from the `subdedispersion` section of the TransientX configuration
+        `dedispersion_config`, so the cube has the same DM trials as the one TransientX would write.
+        By default this is the configuration of the inference pipeline, found relative to this
+        module, so the creator can be run from any directory.
+
+        Only the DM grid is taken from the configuration: the `preprocesslite`, `downsample`,
+        `baseline` and `rfi` sections (including `zaplist`) that `dada_dbdedispdb` applies to
+        the live pages are not applied, so the cube differs from the inference inputs wherever
+        they would have changed the data.
+
+        Returns:
+            SubbandDedisperser: Dedisperser over the configured DM grid.
+        """
+        header = self.filterbank_file.your_header
+        freqs = header.fch1 + header.foff * np.arange(header.nchans)
+        dedispersion_config = self.config.get("dedispersion_config", DEFAULT_DEDISPERSION_CONFIG)
+        print(f'Native dedispersion uses only the DM grid of {dedispersion_config}; '
+              f'its preprocesslite, downsample, baseline and rfi settings are not applied')
+        dms = load_dm_grid(dedispersion_config)
+        return SubbandDedisperser(freqs, header.tsamp, dms, nsub=self.config.get("dedispersion_subbands", 64))
+
+    def _dm_time_cube_key(self):
+        """
+        Cache key of the DM-Time cube: the fingerprints of the files it is built from and its DM trials.
 
         Returns:
-            numpy.ndarray: 2D array where each row corresponds to time series from a .dat file for a specific DM value.
+            str: Key of the cube in the cache.
         """
-        array_size = np.fromfile(self.file_list[0], dtype=np.float32).size
-        dm_time_image = np.empty((len(self.file_list), array_size))
+        if self.dedisperser is not None:
+            return self.cache.key(
+                backend='native', filterbank=file_fingerprint(self.config["filterbank_path"]),
+                dms=self.dm_list, nsub=self.dedisperser.nsub
+            )
+        return self.cache.key(
+            backend='transientx', files=[file_fingerprint(file) for file in self.file_list], dms=self.dm_list
+        )
 
-        for idx, file in tqdm(enumerate(self.file_list), total=len(self.file_list), desc='Processing files'):
-            dm_time_image[idx] = np.fromfile(file, dtype=np.float32)
+    def _load_dm_time_image(self):
+        """
+        Open the DM-Time image as a read-only memory map of the on-disk cache.
 
-        return dm_time_image
+        The cube is built on the first run and reused as long as the files it is built
+        from and its DM trials are unchanged (see `_dm_time_cube_key`). Only the slices
+        that are accessed are read from disk, so the cube never has to fit in memory.
+
+        Returns:
+            numpy.memmap: 2D float32 array of shape (number of DMs, number of time samples).
+        """
+        if self.dedisperser is not None:
+            # Samples near the end have no complete dispersion sweep in the file
+            expected_shape = (len(self.dm_list), self.filterbank_file.your_header.nspectra - self.dedisperser.overlap)
+        else:
+            array_size = self._check_row_lengths() // np.dtype(np.float32).itemsize
+            expected_shape = (len(self.file_list), array_size)
+
+        create = self._dedisperse_dm_time_image if self.dedisperser is not None else self._create_dm_time_image
+        self.dm_time_cube_key = self._dm_time_cube_key()
+        cache_path = self.cache.get_or_create(
+            'DM_time_cube', self.dm_time_cube_key, lambda path: create(path, expected_shape)
+        )
+        return np.load(cache_path, mmap_mode='r')
+
+    def _check_row_lengths(self):
+        """
+        Check that every .dat file has the same length as the first one.
+
+        Returns:
+            int: Size of each .dat file in bytes.
+
+        Raises:
+            ValueError: If any .dat file differs in size from the first one.
+        """
+        sizes = [os.path.getsize(file) for file in self.file_list]
+        mismatched = [(file, size) for file, size in zip(self.file_list, sizes) if size != sizes[0]]
+        if mismatched:
+            details = ', '.join(f'{os.path.basename(file)} ({size} bytes)' for file, size in mismatched)
+            raise ValueError(
+                f"All .dat files must have the length of {os.path.basename(self.file_list[0])} ({sizes[0]} bytes): {details}"
+            )
+        return sizes[0]
+
+    def _create_dm_time_image(self, cache_path, shape):
+        """
+        Create the DM-Time image cache from the list of .dat files.
+
+        The .dat files are read concurrently by `ingest_workers` threads or processes
+        (`ingest_backend`), each reading its file directly into its own row of a
+        float32 .npy memory map.
+
+        Args:
+            cache_path (str): Path of the .npy file to create.
+            shape (tuple): Shape of the cube, (number of DMs, number of time samples).
+        """
+        dm_time_image = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.float32, shape=shape)
+        row_bytes = shape[1] * np.dtype(np.float32).itemsize
+
+        if self.ingest_backend == 'process':
+            # Workers open the memory map themselves, the header is already on disk
+            dm_time_image.flush()
+            executor = ProcessPoolExecutor(max_workers=self.ingest_workers)
+            submit = lambda idx, file: executor.submit(_read_dat_into_cache_row, cache_path, idx, file)
+        elif self.ingest_backend == 'thread':
+            executor = ThreadPoolExecutor(max_workers=self.ingest_workers)
+            submit = lambda idx, file: executor.submit(_read_file_into, file, dm_time_image[idx])
+        else:
+            raise ValueError(f"Unknown ingest backend: {self.ingest_backend}")
+
+        with executor, tqdm(total=row_bytes * shape[0], unit='B', unit_scale=True, desc='Processing files') as pbar:
+            futures = [submit(idx, file) for idx, file in enumerate(self.file_list)]
+            for future in as_completed(futures):
+                pbar.update(future.result())
+
+        dm_time_image.flush()
+
+    def _dedisperse_dm_time_image(self, cache_path, shape):
+        """
+        Create the DM-Time image cache by dedispersing the filterbank file.
+
+        The filterbank file is read in chunks of `dedispersion_chunk_size` samples that overlap
+        by the maximum dispersion delay of the DM grid, and the dedispersed rows of every chunk
+        are written straight into a float32 .npy memory map, so neither the filterbank file nor
+        the cube has to fit in memory.
+
+        Args:
+            cache_path (str): Path of the .npy file to create.
+            shape (tuple): Shape of the cube, (number of DMs, number of time samples).
+        """
+        dm_time_image = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.float32, shape=shape)
+        dedisperse_filterbank(
+            self.filterbank_file, self.dedisperser, dm_time_image,
+            chunk_size=self.config.get("dedispersion_chunk_size", 16384)
+        )
+        dm_time_image.flush()
 
     def _get_position_in_filfile(self, mjd_pulse):
         """
@@ -112,100 +322,314 @@ class DMTimeDataSetCreator:
         location_in_the_file = delta_t_seconds / Decimal(self.filterbank_file.your_header.tsamp)
         return int(round(location_in_the_file, 0))
 
-    def _process_candidates(self, candidates, label, exclude_positions=None, target_count=None):
+    def _mjd_to_samples(self, mjd_pulses):
+        """
+        Convert a column of MJD strings to positions in the filterbank file, all at once.
+
+        The MJDs are split into integer days and fractional days, so the difference to
+        the start of the file is computed without losing precision to the large day
+        count. The remaining float64 error is far below a sample, and the few positions
+        that end up too close to half a sample for it to be trusted are recomputed with
+        the exact Decimal arithmetic of `_get_position_in_filfile`, so the result always
+        matches its rounding.
+
+        Args:
+            mjd_pulses (pd.Series): MJDs of the pulses as decimal strings.
+
+        Returns:
+            numpy.ndarray: int64 positions in the filterbank file.
+        """
+        tstart = float(self.filterbank_file.your_header.tstart)
+        tsamp = float(self.filterbank_file.your_header.tsamp)
+
+        parts = mjd_pulses.str.strip().str.split('.', n=1, expand=True)
+        if parts.shape[1] == 1:
+            parts[1] = None
+        days = pd.to_numeric(parts[0], errors='coerce').to_numpy(dtype=np.float64)
+        fractions = pd.to_numeric('0.' + parts[1].fillna('0'), errors='coerce').to_numpy(dtype=np.float64)
+
+        # Both parts of the start time are exact in float64
+        start_days = np.floor(tstart)
+        start_fraction = tstart - start_days
+
+        delta_t_mjd = (days - start_days) + (fractions - start_fraction)
+        location_in_the_file = delta_t_mjd * 86400 / tsamp
+        positions = np.rint(location_in_the_file)
+
+        # Rows whose rounding could be affected by the float64 error, or that did not parse
+        tolerance = 64 * np.finfo(np.float64).eps * (86400 / tsamp + np.abs(location_in_the_file))
+        distance_to_half = np.abs(np.abs(location_in_the_file - np.floor(location_in_the_file)) - 0.5)
+        uncertain = ~np.isfinite(location_in_the_file) | (distance_to_half <= tolerance)
+
+        positions = np.where(np.isfinite(positions), positions, 0).astype(np.int64)
+        for idx in np.flatnonzero(uncertain):
+            positions[idx] = self._get_position_in_filfile(mjd_pulses.iloc[idx])
+
+        return positions
+
+    def _candidates_key(self):
+        """
+        Cache key of the candidate positions: the content of the candidate file and the timing of the filterbank file.
+
+        Returns:
+            str: Key of the positions in the cache.
+        """
+        header = self.filterbank_file.your_header
+        return self.cache.key(
+            candidates=file_digest(self.transient_x_cands_path), tstart=repr(header.tstart), tsamp=repr(header.tsamp)
+        )
+
+    def _load_candidates(self):
+        """
+        Load the TransientX candidate table with typed columns.
+
+        The MJDs are kept as strings, so they can be converted exactly, and their positions
+        in the filterbank file are computed once for the whole table and stored in the
+        `sample` column used by all later stages. The positions are cached under the
+        hash of the candidate file and the timing of the filterbank file (`_candidates_key`).
+
+        Returns:
+            pd.DataFrame: Candidates sorted by S/N, with a `sample` column.
+        """
+        column_names = ['beam_name', 'nn', 'mjd', 'dm', 'width', 'snr', 'fh', 'fl', 'image_name', 'x', 'name_file']
+        column_types = {
+            'beam_name': str, 'nn': str, 'mjd': str, 'dm': np.float64, 'width': np.float64, 'snr': np.float64,
+            'fh': np.float64, 'fl': np.float64, 'image_name': str, 'x': str, 'name_file': str
+        }
+        candidats = pd.read_csv(
+            self.transient_x_cands_path, sep='\t', names=column_names, dtype=column_types,
+            engine='c', float_precision='round_trip'
+        )
+        positions_path = self.cache.get_or_create(
+            'positions', self._candidates_key(), lambda path: np.save(path, self._mjd_to_samples(candidats['mjd']))
+        )
+        candidats['sample'] = np.load(positions_path)
+        candidats.sort_values(by='snr', inplace=True)
+        return candidats
+
+    def _candidate_strip(self, position):
+        """
+        Get the flipped DM-Time strip covering all `ntsamples` shifted windows of a candidate.
+
+        The strip covers the time samples [position - ntsamples + 1, position + 256), so
+        window `i` of the candidate is `strip[:, ntsamples - 1 - i:ntsamples - 1 - i + 256]`.
+
+        Args:
+            position (int): Position of the candidate in the filterbank file.
+
+        Returns:
+            numpy.ndarray: Read-only view of shape (number of DMs, ntsamples + 255).
+
+        Raises:
+            ValueError: If some of the windows extend beyond the DM-Time image.
+        """
+        first = position - self.ntsamples + 1
+        if first < 0 or position + 256 > self.dm_time_image.shape[1]:
+            raise ValueError(
+                f"Windows of the candidate at position {position} extend beyond the DM-Time image "
+                f"of {self.dm_time_image.shape[1]} samples"
+            )
+        return self.dm_time_image[::-1, first:position + 256]
+
+    def _candidate_windows(self, position):
+        """
+        Build all `ntsamples` shifted windows of a candidate as a strided view of the cube.
+
+        Window `i` covers the time samples [position - i, position - i + 256) and is
+        flipped along the DM axis. No data is copied until the windows are used.
+
+        Args:
+            position (int): Position of the candidate in the filterbank file.
+
+        Returns:
+            numpy.ndarray: Read-only view of shape (ntsamples, number of DMs, 256).
+        """
+        # Flipped strip covering all windows; windows[:, j] starts at position - ntsamples + 1 + j
+        strip = self._candidate_strip(position)
+        windows = np.lib.stride_tricks.sliding_window_view(strip, 256, axis=1)
+
+        # Reorder to (window, DM, time) with window i starting at position - i
+        return windows.transpose(1, 0, 2)[::-1]
+
+    # Number of 'rest of events' windows drawn and normalised together
+    SAMPLING_BATCH = 256
+
+    def _allocate_dataset(self, count, output_path=None, width=256, dtype=np.uint8):
+        """
+        Allocate the records of one category, in memory or as an on-disk .npy shard.
+
+        Args:
+            count (int): Number of records.
+            output_path (str, optional): Path of the .npy shard; in memory if not given.
+            width (int): Number of time samples of a record.
+            dtype (numpy.dtype): Type of the records.
+
+        Returns:
+            numpy.ndarray: Uninitialised array of shape (count, number of DMs, width).
+        """
+        shape = (count, len(self.dm_list), width)
+        if output_path is None:
+            return np.empty(shape, dtype=dtype)
+        return np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=shape)
+
+    def _process_candidates(self, candidates, label, exclude_positions=None, target_count=None, output_path=None):
         """
         Process candidates to extract data or generate random segments for the 'rest' category.
 
         Args:
-            candidates (pd.DataFrame): DataFrame of candidates to process.
+            candidates (pd.DataFrame): DataFrame of candidates to process, with a `sample` column.
             label (str): Category label ('pulses', 'zero DM events', or 'rest of events').
-            exclude_positions (list, optional): List of position ranges to exclude for 'rest of events'.
+            exclude_positions (array-like, optional): (start, end) position ranges to exclude for 'rest of events'.
             target_count (int, optional): Target number of samples for 'rest of events'.
+            output_path (str, optional): Stream the samples into a preallocated .npy shard at this path
+                instead of keeping them in memory.
 
         Returns:
-            numpy.ndarray: Extracted or generated dataset for the given category.
+            numpy.ndarray: Extracted or generated dataset for the given category (a memory map if
+                `output_path` is given). With `store_strips`, pulses and zero DM events are returned
+                as one float32 strip of shape (number of DMs, ntsamples + 255) per candidate, from
+                which `dataset.crop_windows` produces the `ntsamples` normalised windows, and the
+                rest of events as the int64 start positions of its windows in the DM-time cube,
+                which `dataset.crop_cube_windows` crops and normalises.
         """
         if label == 'rest of events':
             # Ensure target count is provided
             if target_count is None:
                 raise ValueError("Target count must be specified for 'rest of events'")
     
-            # Initialize dataset with the target count
-            dataset = np.empty([target_count, len(self.dm_list), 256], dtype=np.uint8)
-            global_index = 0
+            # Initialize dataset with the target count; with `store_strips` only the positions are kept
+            if self.store_strips:
+                dataset = np.empty(target_count, dtype=np.int64) if output_path is None else \
+                    np.lib.format.open_memmap(output_path, mode='w+', dtype=np.int64, shape=(target_count,))
+            else:
+                dataset = self._allocate_dataset(target_count, output_path)
+            exclusion_index = self._build_exclusion_index(exclude_positions if exclude_positions is not None else [])
             
             # Use tqdm to display progress bar
             with tqdm(total=target_count, desc='Processing rest of events') as pbar:
-                while global_index < target_count:
-                    # Generate a random position
-                    position = np.random.randint(0, self.dm_time_image.shape[1] - 256)
-                    
-                    # Check if position overlaps with pulses or artefacts
-                    if not self._is_in_pulse_or_bbrfi(position, exclude_positions):
-                        dataset[global_index] = self.normalize_image_to_255(
-                            self.dm_time_image[:, position:position + 256][::-1]
-                        )
-                        global_index += 1
-                        pbar.update(1)  # Update progress bar
-                
+                for start in range(0, target_count, self.SAMPLING_BATCH):
+                    stop = min(start + self.SAMPLING_BATCH, target_count)
+
+                    # Random positions that do not overlap with pulses or artefacts
+                    positions = self._sample_allowed_positions(exclusion_index, stop - start)
+
+                    if self.store_strips:
+                        dataset[start:stop] = positions
+                    else:
+                        dataset[start:stop] = crop_cube_windows(self.dm_time_image, positions)
+                    pbar.update(stop - start)  # Update progress bar
+
+            if output_path is not None:
+                dataset.flush()
+            return dataset
+        elif self.store_strips:
+            # Process pulses or zero DM events, one strip per candidate
+            dataset = self._allocate_dataset(
+                candidates.shape[0], output_path, width=self.ntsamples + 255, dtype=np.float32
+            )
+
+            for idx, position in enumerate(tqdm(candidates['sample'].to_numpy(), total=candidates.shape[0], desc=f'Processing {label}')):
+                dataset[idx] = self._candidate_strip(position)
+
+            if output_path is not None:
+                dataset.flush()
             return dataset
         else:
             # Process pulses or zero DM events
-            dataset = np.empty([candidates.shape[0] * self.ntsamples, len(self.dm_list), 256], dtype=np.uint8)
+            dataset = self._allocate_dataset(candidates.shape[0] * self.ntsamples, output_path)
             global_index = 0
     
-            for idx, row in tqdm(candidates.iterrows(), total=candidates.shape[0], desc=f'Processing {label}'):
-                position = int(self._get_position_in_filfile(row['mjd']))
-                for i in range(self.ntsamples):
-                    dataset[global_index] = self.normalize_image_to_255(
-                        self.dm_time_image[:, position - i:position - i + 256][::-1]
-                    )
-                    global_index += 1
-    
+            for position in tqdm(candidates['sample'].to_numpy(), total=candidates.shape[0], desc=f'Processing {label}'):
+                # All shifted windows of the candidate, normalised in one batched operation
+                dataset[global_index:global_index + self.ntsamples] = self.normalize_images_to_255(
+                    self._candidate_windows(position)
+                )
+                global_index += self.ntsamples
+
+            if output_path is not None:
+                dataset.flush()
             return dataset
 
 
 
-    def _is_in_pulse_or_bbrfi(self, position, list_of_position):
+    @staticmethod
+    def _build_exclusion_index(list_of_position):
         """
-        Check if a position overlaps with any pulse or BBRFI positions.
+        Build a sorted index of disjoint intervals from (possibly overlapping) position ranges.
 
         Args:
-            position (int): Position to check.
-            list_of_position (list): List of (start, end) position ranges.
+            list_of_position (list): List of inclusive (start, end) position ranges.
 
         Returns:
-            bool: True if position overlaps, False otherwise.
+            numpy.ndarray: Array of shape (n, 2) with sorted, merged inclusive (start, end) ranges.
+        """
+        if len(list_of_position) == 0:
+            return np.empty((0, 2), dtype=np.int64)
+
+        intervals = np.asarray(list_of_position, dtype=np.int64)
+        intervals = intervals[np.argsort(intervals[:, 0], kind='stable')]
+
+        # A new interval starts wherever it neither overlaps nor touches everything before it
+        running_end = np.maximum.accumulate(intervals[:, 1])
+        is_first = np.ones(len(intervals), dtype=bool)
+        is_first[1:] = intervals[1:, 0] > running_end[:-1] + 1
+        first_indices = np.flatnonzero(is_first)
+
+        starts = intervals[first_indices, 0]
+        ends = np.maximum.reduceat(intervals[:, 1], first_indices)
+        return np.column_stack([starts, ends])
+
+    def _sample_allowed_positions(self, exclusion_index, count):
         """
-        for start, end in list_of_position:
-            if start <= position <= end:
-                return True
-        return False
+        Draw random window positions uniformly from the complement of the excluded ranges.
+
+        Positions are drawn from [0, number of time samples - 256) like in the rejection
+        sampling this replaces, but directly from the allowed gaps, so the cost does not
+        depend on how much of the file is excluded.
+
+        Args:
+            exclusion_index (numpy.ndarray): Sorted, merged ranges from `_build_exclusion_index`.
+            count (int): Number of positions to draw.
+
+        Returns:
+            numpy.ndarray: Array of `count` allowed positions.
+
+        Raises:
+            ValueError: If every position is excluded.
+        """
+        high = self.dm_time_image.shape[1] - 256
+
+        # Allowed gaps [gap_start, gap_end) between the excluded ranges
+        in_range = (exclusion_index[:, 1] >= 0) & (exclusion_index[:, 0] < high)
+        excluded = np.clip(exclusion_index[in_range], 0, high)
+        gap_starts = np.concatenate(([0], excluded[:, 1] + 1))
+        gap_ends = np.concatenate((excluded[:, 0], [high]))
+        gap_lengths = np.maximum(gap_ends - gap_starts, 0)
+
+        cumulative_lengths = np.cumsum(gap_lengths)
+        total = cumulative_lengths[-1]
+        if total <= 0:
+            raise ValueError("No positions left to sample 'rest of events' from")
+
+        # Uniform draw over all allowed positions, mapped back to the gap it falls in
+        draws = self.rng.integers(0, total, size=count)
+        gaps = np.searchsorted(cumulative_lengths, draws, side='right')
+        return gap_starts[gaps] + draws - (cumulative_lengths[gaps] - gap_lengths[gaps])
     
     def _generate_exclude_positions(self, pulse_candidates, zero_dm_events):
         """
         Generate a list of positions to exclude based on pulse and BBRFI.
 
         Args:
-            pulse_candidates (pd.DataFrame): DataFrame of pulse candidates.
-            zero_dm_events (pd.DataFrame): DataFrame of zero DM events.
+            pulse_candidates (pd.DataFrame): DataFrame of pulse candidates, with a `sample` column.
+            zero_dm_events (pd.DataFrame): DataFrame of zero DM events, with a `sample` column.
 
         Returns:
-            list: List of (start, end) position ranges to exclude.
+            numpy.ndarray: Array of shape (n, 2) with the (start, end) position ranges to exclude.
         """
-        exclude_positions = []
-    
-        # Add pulse positions
-        for _, row in pulse_candidates.iterrows():
-            position = int(self._get_position_in_filfile(row['mjd']))
-            exclude_positions.append((position - 256, position))
-    
-        # Add zero DM event positions
-        for _, row in zero_dm_events.iterrows():
-            position = int(self._get_position_in_filfile(row['mjd']))
-            exclude_positions.append((position - 256, position))
-    
-        return exclude_positions
+        # Pulse positions followed by zero DM event positions
+        positions = np.concatenate((pulse_candidates['sample'].to_numpy(), zero_dm_events['sample'].to_numpy()))
+        return np.column_stack((positions - 256, positions))
 
 
     def process(self):
@@ -214,19 +638,25 @@ class DMTimeDataSetCreator:
 
         Steps:
             1. Load and categorize candidates.
-            2. Process each category ('pulses', 'zero DM events', 'rest of events').
-            3. Combine datasets, shuffle, and save as .npy files.
+            2. Stream each category ('pulses', 'zero DM events', 'rest of events') into its own
+               preallocated .npy shard on disk. The exclusion ranges and the shards are cached
+               under the keys of their inputs, so only the stages whose inputs changed since an
+               earlier run are recomputed.
+            3. Draw a shuffling permutation and save it, with the shuffled labels and a manifest
+               describing the dataset. The samples themselves are never copied to apply the shuffle;
+               readers such as `dataset.ShardedDataset` apply the permutation lazily.
 
         Outputs:
-            - Combined dataset as a .npy file.
-            - Corresponding labels as a .npy file.
+            - One .npy shard per category, in the cache.
+            - Permutation index as a .npy file.
+            - Corresponding labels, in the shuffled order, as a .npy file.
+            - JSON manifest tying them together.
+
+        Returns:
+            str: Path to the JSON manifest of the dataset.
         """
-        # Load candidates
-        column_names = ['beam_name', 'nn', 'mjd', 'dm', 'width', 'snr', 'fh', 'fl', 'image_name', 'x', 'name_file']
-        candidats = pd.read_csv(self.transient_x_cands_path, sep='\t', names=column_names, dtype=str)
-        candidats['dm'] = candidats['dm'].astype(float)
-        candidats['snr'] = candidats['snr'].astype(float)
-        candidats.sort_values(by='snr', inplace=True)
+        # Load candidates with their positions in the filterbank file
+        candidats = self._load_candidates()
     
         # Categorize candidates
         pulses_range = self.dm_ranges["pulses"]
@@ -234,35 +664,80 @@ class DMTimeDataSetCreator:
         pulse_candidates = candidats[(pulses_range[0] <= candidats['dm']) & (candidats['dm'] <= pulses_range[1])]
         rest = candidats[(candidats['dm'] != 0) & ((pulses_range[0] > candidats['dm']) | (candidats['dm'] > pulses_range[1]))]
     
-        # Generate positions to exclude
-        exclude_positions = self._generate_exclude_positions(pulse_candidates, zero_dm_events)
-    
-        # Process each category
-        dataset_with_pulses = self._process_candidates(pulse_candidates, 'pulses')
-        dataset_with_bbrfi = self._process_candidates(zero_dm_events, 'zero DM events')
-        
-        target_count = len(dataset_with_pulses) + len(dataset_with_bbrfi)
+        # Keys of the inputs shared by all categories
+        candidates_key = self._candidates_key()
+        category_inputs = dict(
+            cube=self.dm_time_cube_key, candidates=candidates_key, dm_ranges=self.dm_ranges,
+            ntsamples=self.ntsamples, store_strips=self.store_strips
+        )
+
+        # Generate positions to exclude, merged into disjoint ranges
+        exclusions_key = self.cache.key(candidates=candidates_key, dm_ranges=self.dm_ranges)
+        exclude_positions = np.load(self.cache.get_or_create(
+            'exclusions', exclusions_key,
+            lambda path: np.save(path, self._build_exclusion_index(self._generate_exclude_positions(pulse_candidates, zero_dm_events)))
+        ))
+
+        # Process each category straight into its shard in the cache
+        base_name = f'{self.name_of_set}_DM_time_dataset_realbased'
+        shards = []
+
+        def category_shard(label, key, candidates, **kwargs):
+            path = self.cache.get_or_create(
+                f"dataset_{label.replace(' ', '_')}", key,
+                lambda output_path: self._process_candidates(candidates, label, output_path=output_path, **kwargs)
+            )
+            return path, len(np.load(path, mmap_mode='r'))
+
+        # Strips expand into ntsamples shifted windows each when they are read
+        kind, samples_per_record = ('strips', self.ntsamples) if self.store_strips else ('windows', 1)
+
+        path, count = category_shard('pulses', self.cache.key(category='pulses', **category_inputs), candidates=pulse_candidates)
+        shards.append(('pulses', 'Pulse', kind, count, samples_per_record, path))
+
+        path, count = category_shard('zero DM events', self.cache.key(category='zero DM events', **category_inputs), candidates=zero_dm_events)
+        shards.append(('zero DM events', 'Artefact', kind, count, samples_per_record, path))
+
+        target_count = sum(count * per_record for _, _, _, count, per_record, _ in shards)
 
         # Generate rest of events
-        dataset_with_rest = self._process_candidates(
-            rest, 
-            'rest of events', 
-            exclude_positions=exclude_positions, 
+        path, count = category_shard(
+            'rest of events',
+            self.cache.key(category='rest of events', exclusions=exclusions_key, target_count=target_count,
+                           seed=self.config.get("seed"), **category_inputs),
+            candidates=rest,
+            exclude_positions=exclude_positions,
             target_count=target_count
-)
-    
-        # Combine datasets and create labels
-        combined_data = np.concatenate((dataset_with_pulses, dataset_with_bbrfi, dataset_with_rest), axis=0)
-        labels = np.array(
-            ['Pulse'] * len(dataset_with_pulses) +
-            ['Artefact'] * (len(dataset_with_bbrfi) + len(dataset_with_rest))
         )
-    
-        # Shuffle data and labels
-        indices = np.random.permutation(len(combined_data))
-        shuffled_data = combined_data[indices]
-        shuffled_labels = labels[indices]
-    
-        # Save final datasets
-        np.save(os.path.join(self.output_dir, f'{self.name_of_set}_DM_time_dataset_realbased.npy'), shuffled_data)
-        np.save(os.path.join(self.output_dir, f'{self.name_of_set}_DM_time_dataset_realbased_labels.npy'), shuffled_labels)
+        shards.append(('rest of events', 'Artefact', 'positions' if self.store_strips else 'windows', count, 1, path))
+
+        # Labels of the samples of all shards concatenated in order
+        labels = np.repeat(
+            [class_name for _, class_name, _, _, _, _ in shards],
+            [count * per_record for _, _, _, count, per_record, _ in shards]
+        )
+
+        # Shuffle by index only; the permutation is applied when the samples are read
+        indices = self.shuffle_rng.permutation(len(labels))
+        np.save(os.path.join(self.output_dir, f'{base_name}_index.npy'), indices)
+        np.save(os.path.join(self.output_dir, f'{base_name}_labels.npy'), labels[indices])
+
+        manifest = {
+            'name': self.name_of_set,
+            'sample_shape': [len(self.dm_list), 256],
+            # Windows of "positions" shards are cropped from the cube in the cache
+            'cube': os.path.relpath(self.dm_time_image.filename, self.output_dir),
+            'shards': [
+                {
+                    'category': label, 'label': class_name, 'kind': kind, 'count': int(count),
+                    'samples_per_record': per_record, 'path': os.path.relpath(path, self.output_dir)
+                }
+                for label, class_name, kind, count, per_record, path in shards
+            ],
+            'index': f'{base_name}_index.npy',
+            'labels': f'{base_name}_labels.npy'
+        }
+        manifest_path = os.path.join(self.output_dir, f'{base_name}.json')
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+        return manifest_path
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import numpy as np
+
+from inference import NUM_DMS
+
+
+def archive_info_path(archive_path):
+    return f'{archive_path}.json'
+
+
+class RecordingReader:
+    """
+    Wraps a DADA reader and tees every page it serves into a DM-time archive.
+
+    The archive is a memory-mapped float32 `.npy` file of shape
+    (n_pages, num_dms, num_samples) holding the raw pages as they came out
+    of the ring buffer, before flipping and normalisation, so any model and
+    any preprocessing can be replayed on them later with `ArchiveReader`.
+    A page is copied into the archive when it is served, while its memory in
+    the ring buffer is still valid.
+
+    The number of recorded pages is written next to the archive, to
+    `<archive>.json`, when the archive is created, at most every `interval`
+    seconds while recording and when the reader disconnects. The archive is
+    flushed before every update and the file is replaced atomically, so after
+    a crash it still counts only pages that are on disk.
+    """
+    def __init__(self, reader, archive_path, n_pages, num_dms=NUM_DMS, metadata=None, interval=1.0):
+        self.reader = reader
+        self.archive_path = archive_path
+        self.n_pages = n_pages
+        self.num_dms = num_dms
+        self.metadata = metadata or {}
+        self.interval = interval
+        self.archive = None
+        self.recorded = 0
+        self.last_save = 0.0
+
+    def getNextPage(self):
+        page = self.reader.getNextPage()
+        data = np.frombuffer(page, dtype=np.float32).reshape(self.num_dms, -1)
+
+        # The size of a page is only known once the first one arrives
+        if self.archive is None:
+            self.archive = np.lib.format.open_memmap(
+                self.archive_path, mode='w+', dtype=np.float32, shape=(self.n_pages, *data.shape)
+            )
+            self._save_info()
+
+        self.archive[self.recorded] = data
+        self.recorded += 1
+        if time.monotonic() - self.last_save >= self.interval:
+            self._save_info()
+        return page
+
+    def _save_info(self):
+        self.archive.flush()
+        tmp_path = f'{archive_info_path(self.archive_path)}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(dict(self.metadata, pages=self.recorded, shape=list(self.archive.shape[1:])), file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, archive_info_path(self.archive_path))
+        self.last_save = time.monotonic()
+
+    def markCleared(self):
+        self.reader.markCleared()
+
+    def disconnect(self):
+        if self.archive is not None:
+            self._save_info()
+            self.archive = None
+        self.reader.disconnect()
+
+
+class ArchiveReader:
+    """
+    Replays a DM-time archive written by `RecordingReader` with the interface
+    of `psrdada.Reader`, so it can be classified by the same batched
+    inference path as a live stream, at the speed of the disk.
+
+    Only the pages recorded according to `<archive>.json` are served; the
+    rest of the preallocated archive was never written. Pages are served
+    straight from the memory map without copying.
+
+    Raises:
+        ValueError: If the archive has no `<archive>.json`, so the number of recorded pages is unknown.
+    """
+    def __init__(self, archive_path):
+        try:
+            with open(archive_info_path(archive_path), 'r') as file:
+                recorded = json.load(file)['pages']
+        except FileNotFoundError:
+            raise ValueError(f"{archive_info_path(archive_path)} is missing, the number of recorded pages "
+                             f"of {archive_path} is unknown") from None
+
+        self.archive = np.load(archive_path, mmap_mode='r')
+        self.n_pages = min(len(self.archive), recorded)
+        self.served = 0
+
+    def __len__(self):
+        return self.n_pages
+
+    def seek(self, page):
+        """
+        Continues the replay at `page`.
+        """
+        self.served = page
+
+    def getNextPage(self):
+        if self.served >= self.n_pages:
+            raise RuntimeError("No more pages in the archive")
+        page = self.archive[self.served]
+        self.served += 1
+        return memoryview(page).cast('B')
+
+    def markCleared(self):
+        pass
+
+    def disconnect(self):
+        self.archive = None
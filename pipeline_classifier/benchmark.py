@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import functools
+import subprocess
+import numpy as np
+
+from inference import classify_stream
+from metrics import StageMetrics
+
+TRAINING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'single_pulse_classifier_training')
+RESOLUTIONS = (256, 128, 64, 32)
+INPUT_DTYPES = ('uint8', 'float32')
+
+
+class SyntheticReader:
+    """
+    In-process stand-in for `psrdada.Reader` serving synthetic DM-time pages.
+
+    Every page is a (num_dms × num_samples) float32 plane of Gaussian noise.
+    Every `pulse_every`-th page also holds a dispersed pulse: sharp at its
+    DM trial and smeared over more time samples the further a DM trial is
+    from it, which gives the bow-tie shape of a real dedispersed pulse. A
+    pool of pages is generated up front, so serving a page costs no more
+    than it does from a ring buffer.
+    """
+    def __init__(self, n_pages, num_dms=256, num_samples=256, pulse_every=4, pool_size=64, seed=42):
+        self.n_pages = n_pages
+        self.served = 0
+
+        rng = np.random.default_rng(seed)
+        self.pool = rng.normal(size=(pool_size, num_dms, num_samples)).astype(np.float32)
+
+        dm_rows = np.arange(num_dms)[:, np.newaxis]
+        samples = np.arange(num_samples)[np.newaxis, :]
+        for page in self.pool[::pulse_every]:
+            dm_row = rng.integers(num_dms // 4, 3 * num_dms // 4)
+            centre = rng.integers(num_samples // 4, 3 * num_samples // 4)
+            amplitude = rng.uniform(5, 20)
+
+            # Pulse width grows with the DM error, its flux is spread over the width
+            width = 1 + np.abs(dm_rows - dm_row) * (num_samples / num_dms) / 4
+            page += np.where(np.abs(samples - centre) <= width / 2, amplitude / width, 0).astype(np.float32)
+
+    def getNextPage(self):
+        if self.served >= self.n_pages:
+            raise RuntimeError("No more pages in the synthetic stream")
+        page = self.pool[self.served % len(self.pool)]
+        self.served += 1
+        return memoryview(page).cast('B')
+
+    def markCleared(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class RecordingMetrics(StageMetrics):
+    """
+    `StageMetrics` that also keeps every page latency for exact percentiles.
+    """
+    def __init__(self):
+        super().__init__(prefix='single_pulse_benchmark')
+        self.page_latencies = []
+
+    def observe(self, stage, seconds):
+        super().observe(stage, seconds)
+        if stage == 'page_latency':
+            self.page_latencies.append(seconds)
+
+
+@functools.lru_cache(maxsize=None)
+def build_model(model_name, resolution):
+    """
+    Builds an untrained model from `training_models.models_htable`; the
+    weights do not change the cost of a forward pass. The model is cached,
+    so the warm-up and the measured run share it.
+    """
+    sys.path.insert(0, TRAINING_DIR)
+    from training_models import models_htable
+    return models_htable[model_name](resolution)
+
+
+def run_one(model_name, resolution, input_dtype, n_pages, batch_size, workers):
+    """
+    Classifies `n_pages` synthetic pages with one model/resolution/input type
+    combination and returns the measured throughput, latency and memory.
+    """
+    reader = SyntheticReader(n_pages, num_dms=resolution, num_samples=resolution)
+    metrics = RecordingMetrics()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        predictions_array = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, 'predictions.npy'), dtype=np.int32, mode='w+', shape=(n_pages,)
+        )
+        model_factory = functools.partial(build_model, model_name, resolution)
+
+        # Warm-up run, so graph building and allocation are not measured
+        warm_up_pages = min(n_pages, 2 * batch_size)
+        classify_stream(model_factory, SyntheticReader(warm_up_pages, resolution, resolution),
+                        predictions_array, warm_up_pages, batch_size=batch_size,
+                        input_dtype=input_dtype, workers=workers, num_dms=resolution)
+
+        start = time.perf_counter()
+        classify_stream(model_factory, reader, predictions_array, n_pages, batch_size=batch_size,
+                        input_dtype=input_dtype, workers=workers, num_dms=resolution, metrics=metrics)
+        elapsed = time.perf_counter() - start
+
+    latencies = np.array(metrics.page_latencies) * 1000
+    return {
+        'model': model_name,
+        'resolution': resolution,
+        'input_dtype': input_dtype,
+        'spectra_per_second': n_pages / elapsed,
+        'p50_latency_ms': float(np.percentile(latencies, 50)),
+        'p99_latency_ms': float(np.percentile(latencies, 99)),
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+def combination_key(result):
+    return f"{result['model']}_{result['resolution']}_{result['input_dtype']}"
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Returns a list of regressions of `results` against `baseline`.
+    """
+    regressions = []
+    for result in results:
+        key = combination_key(result)
+        if key not in baseline:
+            continue
+        reference = baseline[key]
+        if result['spectra_per_second'] < reference['spectra_per_second'] * (1 - tolerance):
+            regressions.append(f"{key}: {result['spectra_per_second']:.1f} spectra/s, baseline {reference['spectra_per_second']:.1f}")
+        if result['p99_latency_ms'] > reference['p99_latency_ms'] * (1 + tolerance):
+            regressions.append(f"{key}: p99 latency {result['p99_latency_ms']:.2f} ms, baseline {reference['p99_latency_ms']:.2f} ms")
+        if result['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{key}: peak RSS {result['peak_rss_mb']:.0f} MB, baseline {reference['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput benchmark of the inference pipeline on synthetic DADA pages')
+    parser.add_argument('--models', nargs='+', default=None, help='Models from models_htable (default: all)')
+    parser.add_argument('--resolutions', nargs='+', type=int, default=list(RESOLUTIONS))
+    parser.add_argument('--input-dtypes', nargs='+', default=list(INPUT_DTYPES))
+    parser.add_argument('-n', '--n-pages', type=int, default=2048, help='Pages classified per combination')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--baseline', type=str, default='benchmark_baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--run-one', nargs=3, metavar=('MODEL', 'RESOLUTION', 'INPUT_DTYPE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        # Single combination, run in its own process so the peak RSS is its own
+        model_name, resolution, input_dtype = args.run_one
+        result = run_one(model_name, int(resolution), input_dtype, args.n_pages, args.batch_size, args.workers)
+        print(json.dumps(result))
+        return
+
+    if args.models is None:
+        sys.path.insert(0, TRAINING_DIR)
+        from training_models import models_htable
+        args.models = list(models_htable)
+
+    results = []
+    for model_name in args.models:
+        for resolution in args.resolutions:
+            for input_dtype in args.input_dtypes:
+                command = [
+                    sys.executable, os.path.abspath(__file__),
+                    '--run-one', model_name, str(resolution), input_dtype,
+                    '-n', str(args.n_pages), '--batch-size', str(args.batch_size), '--workers', str(args.workers)
+                ]
+                output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout.decode()
+                result = json.loads(output.strip().splitlines()[-1])
+                results.append(result)
+                print(f"{combination_key(result)}: {result['spectra_per_second']:.1f} spectra/s, "
+                      f"p50 {result['p50_latency_ms']:.2f} ms, p99 {result['p99_latency_ms']:.2f} ms, "
+                      f"peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({combination_key(result): result for result in results}, file, indent=4)
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --update-baseline to create one')
+        return
+
+    with open(args.baseline, 'r') as file:
+        baseline = json.load(file)
+
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print('PERFORMANCE REGRESSION against the baseline:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+
+    print('No regressions against the baseline.')
+
+
+if __name__ == "__main__":
+    main()
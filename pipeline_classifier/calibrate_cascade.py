@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+from utils import load_config
+from engines import load_classifier, load_prefilter
+
+DATASET_CREATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DM_time_dataset_creator')
+PULSE_QUANTILES = (0, 0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2)
+
+
+def load_labelled_dataset(args):
+    """
+    (source, is_pulse) of the labelled dataset: a `ShardedDataset` manifest
+    written by the dataset creator, or a flat .npy of images with a .npy of labels.
+    """
+    if args.dataset.endswith('.json'):
+        sys.path.insert(0, DATASET_CREATOR_DIR)
+        from dataset import ShardedDataset
+        source = ShardedDataset(args.dataset)
+        labels = source.labels
+    else:
+        source = np.load(args.dataset, mmap_mode='r')
+        labels = np.load(args.labels)
+
+    # Labels are class names, or already encoded with 'Pulse' as 1
+    labels = np.asarray(labels)
+    if np.issubdtype(labels.dtype, np.integer):
+        return source, labels == 1
+    return source, labels == 'Pulse'
+
+
+def score_dataset(source, n_samples, prefilter, classifier, batch_size, input_dtype):
+    """
+    Prefilter scores and full-model predictions of the first `n_samples`
+    samples, with the time spent in each stage.
+    """
+    scores = np.empty(n_samples, dtype=np.float32)
+    predictions = np.empty(n_samples, dtype=np.int32)
+    prefilter_time = classifier_time = 0.0
+
+    for start in range(0, n_samples, batch_size):
+        stop = min(start + batch_size, n_samples)
+        read = getattr(source, 'get_batch', None)
+        images = read(np.arange(start, stop)) if read is not None else np.asarray(source[start:stop])
+        images = images[..., np.newaxis].astype(input_dtype, copy=False)
+
+        t0 = time.perf_counter()
+        scores[start:stop] = prefilter(images)
+        t1 = time.perf_counter()
+        predictions[start:stop] = np.argmax(np.asarray(classifier(images, training=False)), axis=-1)
+        t2 = time.perf_counter()
+
+        prefilter_time += t1 - t0
+        classifier_time += t2 - t1
+
+    return scores, predictions, prefilter_time / n_samples, classifier_time / n_samples
+
+
+def calibrate(scores, predictions, is_pulse, thresholds, prefilter_time, classifier_time):
+    """
+    Recall lost and throughput gained by the cascade at every threshold.
+
+    The recall is that of the pulses found by the full model alone; a pulse
+    is lost when the full model finds it but its score is below the
+    threshold. The throughput is estimated from the measured time per page
+    of both stages, as the prefilter runs on every page and the full model
+    only on the pages that pass.
+    """
+    found = is_pulse & (predictions == 1)
+    full_recall = found.sum() / max(is_pulse.sum(), 1)
+    full_throughput = 1 / classifier_time
+
+    results = []
+    for threshold in thresholds:
+        passed = scores >= threshold
+        recall = (found & passed).sum() / max(is_pulse.sum(), 1)
+        pass_fraction = passed.mean()
+        throughput = 1 / (prefilter_time + pass_fraction * classifier_time)
+        results.append({
+            'threshold': float(threshold),
+            'pass_fraction': float(pass_fraction),
+            'recall': float(recall),
+            'recall_lost': float(full_recall - recall),
+            'false_positives': int((passed & ~is_pulse & (predictions == 1)).sum()),
+            'pages_per_second': float(throughput),
+            'speedup': float(throughput / full_throughput)
+        })
+    return float(full_recall), float(full_throughput), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall lost and throughput gained by the cascade prefilter per threshold')
+    parser.add_argument('-c', '--config', type=str, default='config.json', help='Pipeline config file with the cascade settings')
+    parser.add_argument('--dataset', type=str, required=True, help='Dataset manifest (.json) or flat images (.npy)')
+    parser.add_argument('--labels', type=str, default=None, help='Labels (.npy) of flat images')
+    parser.add_argument('--limit', type=int, default=None, help='Number of samples used (default: all)')
+    parser.add_argument('--thresholds', nargs='+', type=float, default=None,
+                        help='Thresholds to evaluate (default: quantiles of the pulse scores)')
+    parser.add_argument('-o', '--output', type=str, default='cascade_calibration.json')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if not config.get("cascade_prefilter"):
+        parser.error('Set cascade_prefilter in the config to the prefilter to calibrate')
+
+    # Full model alone and prefilter, as the cascade would load them
+    prefilter = load_prefilter(config)
+    classifier = load_classifier(dict(config, cascade_prefilter=None))
+
+    source, is_pulse = load_labelled_dataset(args)
+    n_samples = min(args.limit or len(source), len(source))
+    is_pulse = is_pulse[:n_samples]
+
+    scores, predictions, prefilter_time, classifier_time = score_dataset(
+        source, n_samples, prefilter, classifier, config.get("batch_size", 64), config.get("input_dtype", "uint8")
+    )
+
+    # By default, thresholds that keep fixed fractions of the pulses
+    thresholds = args.thresholds or sorted(set(np.quantile(scores[is_pulse], PULSE_QUANTILES).tolist()))
+    full_recall, full_throughput, results = calibrate(scores, predictions, is_pulse, thresholds, prefilter_time, classifier_time)
+
+    print(f'{n_samples} samples, {is_pulse.sum()} pulses; full model: recall {full_recall:.4f}, '
+          f'{full_throughput:.1f} pages/s; prefilter: {1 / prefilter_time:.1f} pages/s')
+    for result in results:
+        print(f"threshold {result['threshold']:.4g}: {result['pass_fraction'] * 100:.2f}% pass, "
+              f"recall lost {result['recall_lost']:.4f}, {result['pages_per_second']:.1f} pages/s "
+              f"({result['speedup']:.2f}x)")
+
+    with open(args.output, 'w') as file:
+        json.dump({
+            'prefilter': config["cascade_prefilter"],
+            'samples': n_samples,
+            'pulses': int(is_pulse.sum()),
+            'full_recall': full_recall,
+            'full_pages_per_second': full_throughput,
+            'prefilter_pages_per_second': 1 / prefilter_time,
+            'results': results
+        }, file, indent=4)
+    print(f'Calibration saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
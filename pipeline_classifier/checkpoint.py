@@ -0,0 +1,69 @@
+import os
+import json
+import time
+
+
+def checkpoint_path(predictions_path):
+    return f'{predictions_path}.checkpoint.json'
+
+
+def load_checkpoint(predictions_path):
+    """
+    Returns the checkpoint of a predictions file, or None if it has none.
+    """
+    try:
+        with open(checkpoint_path(predictions_path), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+class ProgressCheckpoint:
+    """
+    Records how many leading pages of a predictions file are final.
+
+    Batches finish out of order with several workers, so the checkpoint
+    tracks the finished page ranges and only advances over the contiguous
+    prefix `[0, completed)` of pages whose predictions have been written and
+    flushed. The prefix is saved to `<predictions>.checkpoint.json` at most
+    every `interval` seconds and once more at the end of the stream. The
+    file is written under a temporary name and renamed, so it always holds a
+    complete checkpoint, even if the process is killed while writing it.
+    """
+    def __init__(self, predictions_path, n_spectra, completed=0, interval=1.0):
+        self.path = checkpoint_path(predictions_path)
+        self.predictions_path = predictions_path
+        self.n_spectra = n_spectra
+        self.completed = completed
+        self.interval = interval
+        self.finished = {}  # Start -> stop of finished ranges beyond the prefix
+        self.saved = None
+        self.last_save = 0.0
+
+    def mark_done(self, start, stop):
+        """
+        Marks the pages `[start, stop)` as finished and saves the checkpoint
+        if the prefix advanced and the last save is older than `interval`.
+        """
+        self.finished[start] = stop
+        while self.completed in self.finished:
+            self.completed = self.finished.pop(self.completed)
+
+        if self.completed != self.saved and time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        state = {
+            'predictions': os.path.basename(self.predictions_path),
+            'completed': self.completed,
+            'n_spectra': self.n_spectra
+        }
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(state, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+        self.saved = self.completed
+        self.last_save = time.monotonic()
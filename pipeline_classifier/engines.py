@@ -0,0 +1,168 @@
+import os
+import threading
+import numpy as np
+
+from preprocessing import downsample
+
+ARTEFACT_CLASS = 0  # Class index of everything that is not a pulse
+
+
+class TFLiteClassifier:
+    """
+    Runs a (post-training quantized) TFLite model with the same calling
+    convention as a Keras model: `classifier(images, training=False)`
+    returns the class probabilities of a batch.
+
+    TFLite interpreters are not thread-safe, so every thread that calls the
+    classifier gets its own interpreter.
+    """
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self._local = threading.local()
+
+    def _interpreter(self):
+        if not hasattr(self._local, 'interpreter'):
+            import tensorflow as tf
+            interpreter = tf.lite.Interpreter(model_path=self.model_path, num_threads=self.num_threads)
+            interpreter.allocate_tensors()
+            self._local.interpreter = interpreter
+        return self._local.interpreter
+
+    def __call__(self, images, training=False):
+        interpreter = self._interpreter()
+        input_detail = interpreter.get_input_details()[0]
+        output_detail = interpreter.get_output_details()[0]
+
+        # Resize the input only when the batch shape changes
+        if tuple(input_detail['shape']) != images.shape:
+            interpreter.resize_tensor_input(input_detail['index'], images.shape)
+            interpreter.allocate_tensors()
+
+        # Quantize the input if the model expects a different integer type
+        scale, zero_point = input_detail['quantization']
+        if images.dtype != input_detail['dtype'] and scale and np.issubdtype(input_detail['dtype'], np.integer):
+            info = np.iinfo(input_detail['dtype'])
+            images = np.clip(np.round(images / scale + zero_point), info.min, info.max)
+        interpreter.set_tensor(input_detail['index'], images.astype(input_detail['dtype'], copy=False))
+        interpreter.invoke()
+
+        # Dequantize integer outputs back to probabilities
+        output = interpreter.get_tensor(output_detail['index'])
+        scale, zero_point = output_detail['quantization']
+        if scale and np.issubdtype(output.dtype, np.integer):
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+
+def peak_snr_score(images, time_bin=4):
+    """
+    Cheap pulse statistic of a batch of DM-time images.
+
+    Every DM row is averaged over blocks of `time_bin` samples and its peak
+    S/N is measured against the mean and standard deviation of the row. A
+    dispersed pulse gives a profile of peak S/N over DM that rises towards
+    its DM and falls off on both sides, while noise gives a flat profile, so
+    the score is the height of the profile's maximum above its median.
+    """
+    images = np.asarray(images, dtype=np.float32).reshape(len(images), images.shape[1], images.shape[2])
+    n_images, n_dms, n_samples = images.shape
+    n_samples -= n_samples % time_bin
+
+    binned = images[:, :, :n_samples].reshape(n_images, n_dms, -1, time_bin).mean(axis=-1)
+    mean = binned.mean(axis=-1)
+    std = binned.std(axis=-1)
+    profile = (binned.max(axis=-1) - mean) / np.maximum(std, np.finfo(np.float32).eps)
+    return profile.max(axis=1) - np.median(profile, axis=1)
+
+
+class ModelPrefilter:
+    """
+    Prefilter that scores pages with a small model on a downsampled plane,
+    e.g. the 32x32 variant of a model from `models_htable`.
+
+    The score of a page is the pulse probability of the small model.
+    """
+    def __init__(self, model, resolution=32, pulse_class=1):
+        self.model = model
+        self.resolution = resolution
+        self.pulse_class = pulse_class
+
+    def __call__(self, images):
+        images = np.asarray(images)
+        planes = downsample(images.reshape(images.shape[:3]).astype(np.uint8, copy=False), self.resolution)
+        probabilities = np.asarray(self.model(planes[..., np.newaxis].astype(np.float32), training=False))
+        return probabilities[:, self.pulse_class]
+
+
+class CascadeClassifier:
+    """
+    Two-stage classifier with the calling convention of a Keras model.
+
+    Every page of a batch is scored by the cheap `prefilter`; only the pages
+    scoring at least `threshold` are passed to the full `classifier`. The
+    other pages are classified as artefacts without running the full model.
+    """
+    def __init__(self, classifier, prefilter, threshold, n_classes=2):
+        self.classifier = classifier
+        self.prefilter = prefilter
+        self.threshold = threshold
+        self.n_classes = n_classes
+
+    def __call__(self, images, training=False):
+        passed = self.prefilter(images) >= self.threshold
+
+        probabilities = np.zeros((len(images), self.n_classes), dtype=np.float32)
+        probabilities[:, ARTEFACT_CLASS] = 1
+        if passed.any():
+            probabilities[passed] = np.asarray(self.classifier(images[passed], training=training))
+        return probabilities
+
+
+def load_prefilter(config):
+    """
+    Loads the first stage of the cascade selected by `cascade_prefilter`.
+
+    - `peak_snr`: the `peak_snr_score` statistic of the page.
+    - `model`: the small Keras model `name_of_the_prefilter_model` applied to
+      the page downsampled to `prefilter_resolution`.
+    """
+    prefilter = config.get("cascade_prefilter")
+
+    if prefilter == "peak_snr":
+        return peak_snr_score
+    elif prefilter == "model":
+        from tensorflow.keras.models import load_model
+        model = load_model(f'{config["path_to_models"]}{config["name_of_the_prefilter_model"]}')
+        return ModelPrefilter(model, config.get("prefilter_resolution", 32))
+
+    raise ValueError(f"Unknown cascade prefilter: {prefilter}")
+
+
+def load_classifier(config):
+    """
+    Loads the classifier selected by `inference_engine` in the configuration.
+
+    - `keras`: the float32 Keras model `name_of_the_model`.
+    - `tflite_int8`: the int8 engine `name_of_the_quantized_model` created
+      by `single_pulse_classifier_training/quantize_model.py`.
+
+    With `cascade_prefilter` set, the classifier becomes the second stage of
+    a `CascadeClassifier` that only sees pages scoring at least
+    `cascade_threshold` in the prefilter (see `load_prefilter`).
+    """
+    engine = config.get("inference_engine", "keras")
+
+    if engine == "keras":
+        from tensorflow.keras.models import load_model
+        classifier = load_model(f'{config["path_to_models"]}{config["name_of_the_model"]}')
+    elif engine == "tflite_int8":
+        workers = max(1, config.get("workers_for_tensorflow", 1))
+        num_threads = config.get("threads_for_tflite", max(1, (os.cpu_count() or 1) // workers))
+        classifier = TFLiteClassifier(f'{config["path_to_models"]}{config["name_of_the_quantized_model"]}', num_threads)
+    else:
+        raise ValueError(f"Unknown inference engine: {engine}")
+
+    if config.get("cascade_prefilter"):
+        return CascadeClassifier(classifier, load_prefilter(config), config["cascade_threshold"])
+    return classifier
@@ -0,0 +1,65 @@
+import shutil
+import struct
+
+# Types of the values of the SIGPROC header keywords
+INT_KEYWORDS = {'telescope_id', 'machine_id', 'data_type', 'barycentric', 'pulsarcentric', 'nbits',
+                'nsamples', 'nchans', 'nifs', 'nbeams', 'ibeam'}
+DOUBLE_KEYWORDS = {'tstart', 'tsamp', 'fch1', 'foff', 'refdm', 'az_start', 'za_start', 'src_raj', 'src_dej',
+                   'period', 'fchannel'}
+STRING_KEYWORDS = {'source_name', 'rawdatafile'}
+
+
+def _read_string(file):
+    length, = struct.unpack('<i', file.read(4))
+    return file.read(length).decode()
+
+
+def read_header(path):
+    """
+    Reads the header of a SIGPROC filterbank file.
+
+    Returns `(header, header_size, offsets)`: the keyword values, the size of
+    the header in bytes and the byte offset of the value of every keyword.
+    """
+    header, offsets = {}, {}
+    with open(path, 'rb') as file:
+        if _read_string(file) != 'HEADER_START':
+            raise ValueError(f"{path} is not a SIGPROC filterbank file")
+
+        while True:
+            keyword = _read_string(file)
+            if keyword == 'HEADER_END':
+                return header, file.tell(), offsets
+
+            offsets[keyword] = file.tell()
+            if keyword in INT_KEYWORDS:
+                header[keyword], = struct.unpack('<i', file.read(4))
+            elif keyword in DOUBLE_KEYWORDS:
+                header[keyword], = struct.unpack('<d', file.read(8))
+            elif keyword in STRING_KEYWORDS:
+                header[keyword] = _read_string(file)
+            elif keyword not in ('FREQUENCY_START', 'FREQUENCY_END'):
+                raise ValueError(f"Unknown SIGPROC header keyword {keyword} in {path}")
+
+
+def write_truncated_filterbank(path, output_path, start_sample):
+    """
+    Writes the filterbank file `path` from spectrum `start_sample` on to
+    `output_path`, with `tstart` moved to the time of that spectrum.
+
+    The header is copied byte for byte apart from the value of `tstart`, so
+    all other keywords are kept exactly.
+    """
+    header, header_size, offsets = read_header(path)
+    bytes_per_spectrum = header['nchans'] * header.get('nifs', 1) * header['nbits'] // 8
+    tstart = header['tstart'] + start_sample * header['tsamp'] / 86400
+
+    with open(path, 'rb') as source, open(output_path, 'wb') as output:
+        header_bytes = bytearray(source.read(header_size))
+        header_bytes[offsets['tstart']:offsets['tstart'] + 8] = struct.pack('<d', tstart)
+        output.write(header_bytes)
+
+        source.seek(header_size + start_sample * bytes_per_spectrum)
+        shutil.copyfileobj(source, output, 16 << 20)
+
+    return tstart
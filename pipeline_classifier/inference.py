@@ -0,0 +1,435 @@
+import os
+import time
+import queue
+import threading
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+from preprocessing import normalize_into
+from metrics import StageMetrics
+
+NUM_DMS = 256  # Fixed number of DM trials in a DM-time page
+
+# Marker placed in a queue once its producer has nothing more to deliver
+_END_OF_STREAM = None
+
+
+class BatchArena:
+    """
+    Preallocated model-input buffers shared by the page reader and the classifier.
+
+    The arena is split into `n_slots` slots of `batch_size` images each. The
+    reader takes a free slot, fills it page by page and the classifier hands
+    the slot back once every image in it has been classified. The buffers are
+    allocated once, when the shape of the first page is known, and reused for
+    the rest of the stream.
+    """
+    def __init__(self, n_slots, batch_size, dtype=np.uint8):
+        self.n_slots = n_slots
+        self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
+        self.images = None
+        self.scratch = None
+
+        # When each row was handed to the classifier, for the end-to-end page latency
+        self.ready_times = np.zeros((n_slots, batch_size))
+
+        self.free_slots = queue.Queue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+
+    def allocate(self, image_shape):
+        # Model input: (slot, batch, DM trials, time samples, channel)
+        self.images = np.empty(self._images_shape(image_shape), dtype=self.dtype)
+
+        # Float32 work area for the normalisation, only used by the reader thread
+        self.scratch = np.empty(image_shape, dtype=np.float32)
+
+    def close(self):
+        pass
+
+    def _images_shape(self, image_shape):
+        return (self.n_slots, self.batch_size, *image_shape, 1)
+
+
+class SharedBatchArena(BatchArena):
+    """
+    `BatchArena` whose images live in shared memory so that inference
+    processes can read them without copying.
+    """
+    def __init__(self, n_slots, batch_size, dtype=np.uint8):
+        super().__init__(n_slots, batch_size, dtype)
+        self.shared_memory = None
+
+    def allocate(self, image_shape):
+        shape = self._images_shape(image_shape)
+        self.shared_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * self.dtype.itemsize)
+        self.images = np.ndarray(shape, dtype=self.dtype, buffer=self.shared_memory.buf)
+        self.scratch = np.empty(image_shape, dtype=np.float32)
+
+    def descriptor(self):
+        """
+        Returns what another process needs to attach to the images.
+        """
+        return self.shared_memory.name, self.images.shape, self.dtype.str
+
+    def close(self):
+        if self.shared_memory is not None:
+            self.images = None
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+            self.shared_memory = None
+
+
+class PageReader(threading.Thread):
+    """
+    Background thread that moves pages from a DADA reader into a `BatchArena`.
+
+    Every page is read in place from the ring buffer memory, flipped and
+    normalised straight into its slot of the arena. The page is released with
+    `markCleared()` only after that, and its position is announced on the
+    `ready` queue as a `(slot, row, sequence number)` tuple. The sequence
+    number is the index of the page in the stream, and the row of a page in
+    its slot is always `sequence number % batch_size`.
+
+    The time spent waiting in `getNextPage()`, preprocessing and in
+    `markCleared()` is recorded in `metrics`.
+    """
+    def __init__(self, reader, n_pages, arena, num_dms=NUM_DMS, metrics=None):
+        super().__init__(daemon=True)
+        self.reader = reader
+        self.n_pages = n_pages
+        self.arena = arena
+        self.num_dms = num_dms
+        self.metrics = metrics if metrics is not None else StageMetrics()
+        self.ready = queue.Queue()
+        self.error = None
+
+    def run(self):
+        try:
+            slot = None
+            for seq in range(self.n_pages):
+                row = seq % self.arena.batch_size
+                if row == 0:
+                    # Blocks until the classifier returns a slot, which bounds prefetching
+                    slot = self.arena.free_slots.get()
+
+                # Get next data page from DADA buffer
+                t0 = time.perf_counter()
+                page = self.reader.getNextPage()
+                t1 = time.perf_counter()
+
+                # View the page memory as (DM trials × time samples) without copying
+                data = np.frombuffer(page, dtype=np.float32).reshape(self.num_dms, -1)
+
+                if self.arena.images is None:
+                    self.arena.allocate(data.shape)
+                elif data.shape != self.arena.scratch.shape:
+                    raise ValueError(f"Page {seq} has shape {data.shape}, expected {self.arena.scratch.shape}")
+
+                # Flip vertically and normalise directly into the model-input slot
+                normalize_into(data, self.arena.images[slot, row, ..., 0], self.arena.scratch, flip=True)
+                del data
+                t2 = time.perf_counter()
+
+                # The page has been consumed, hand it back to the ring buffer
+                self.reader.markCleared()
+                t3 = time.perf_counter()
+
+                self.metrics.observe('wait_page', t1 - t0)
+                self.metrics.observe('preprocess', t2 - t1)
+                self.metrics.observe('mark_cleared', t3 - t2)
+
+                self.arena.ready_times[slot, row] = t3
+                self.ready.put((slot, row, seq))
+        except Exception as error:
+            self.error = error
+        finally:
+            self.ready.put(_END_OF_STREAM)
+
+
+def classify_images(model, images, predictions_array, start):
+    """
+    Classifies a batch of preprocessed images with a single model call.
+
+    Predictions are written to `predictions_array[start:start + len(images)]`.
+    Returns the time spent in the model forward pass and in the memmap write.
+    """
+    # Run model inference on the whole batch (disable training-specific ops)
+    t0 = time.perf_counter()
+    prediction = np.asarray(model(images, training=False))
+    t1 = time.perf_counter()
+
+    # Store the class with highest probability for every spectrum of the batch
+    predictions_array[start:start + len(images)] = np.argmax(prediction, axis=-1)
+    predictions_array.flush()
+    t2 = time.perf_counter()
+
+    return t1 - t0, t2 - t1
+
+
+def _worker_loop(model, get_images, work_queue, done_queue, predictions_array):
+    """
+    Classifies work items `(slot, start, stop, first_seq, ...)` until the
+    end-of-stream marker arrives, and reports every finished item on
+    `done_queue` as `(slot, start, stop, first_seq, error, stage timings)`.
+    """
+    while True:
+        work = work_queue.get()
+        if work is _END_OF_STREAM:
+            break
+
+        slot, start, stop, first_seq = work[:4]
+        error = None
+        timings = {}
+        try:
+            timings['forward'], timings['write'] = classify_images(model, get_images(work), predictions_array, first_seq)
+        except Exception:
+            error = traceback.format_exc()
+
+        # The slot is released even after an error, so the reader never stalls
+        done_queue.put((slot, start, stop, first_seq, error, timings))
+
+
+def _process_worker(model_factory, predictions_path, intra_op_threads, work_queue, done_queue):
+    """
+    Entry point of an inference process: loads its own copy of the model
+    with `intra_op_threads` TensorFlow threads and serves work items from
+    the shared arena.
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    try:
+        model = model_factory()
+    except Exception:
+        # Keep serving work items so the failure is reported instead of stalling the stream
+        load_error = traceback.format_exc()
+
+        def model(*args, **kwargs):
+            raise RuntimeError(load_error)
+
+    predictions_array = np.load(predictions_path, mmap_mode='r+')
+    attached = {}
+
+    def get_images(work):
+        slot, start, stop, _, (name, shape, dtype) = work
+        if name not in attached:
+            memory = shared_memory.SharedMemory(name=name)
+            attached[name] = (memory, np.ndarray(shape, dtype=np.dtype(dtype), buffer=memory.buf))
+        return attached[name][1][slot, start:stop]
+
+    try:
+        _worker_loop(model, get_images, work_queue, done_queue, predictions_array)
+    finally:
+        predictions_array.flush()
+        for memory, _ in attached.values():
+            memory.close()
+
+
+def _check_workers(pool):
+    """
+    Raises a RuntimeError if an inference worker has exited before the end
+    of the stream, e.g. after an import error, running out of memory or a
+    crash, instead of waiting forever for the slots it holds.
+    """
+    for worker in pool:
+        if not worker.is_alive():
+            exitcode = getattr(worker, 'exitcode', None)
+            raise RuntimeError(
+                f"Inference worker {worker.name} exited before the end of the stream"
+                + (f" with exit code {exitcode}" if exitcode is not None else "")
+            )
+
+
+class _Collector(threading.Thread):
+    """
+    Collects finished work items, returns completed slots to the arena and
+    keeps track of progress, errors and stage timings. Pages classified
+    without error are reported to the `checkpoint`, if any.
+    """
+    def __init__(self, arena, done_queue, metrics, progress=None, checkpoint=None):
+        super().__init__(daemon=True)
+        self.arena = arena
+        self.done_queue = done_queue
+        self.metrics = metrics
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.rows_done = [0] * arena.n_slots
+        self.classified = 0
+        self.errors = []
+
+    def run(self):
+        while True:
+            done = self.done_queue.get()
+            if done is _END_OF_STREAM:
+                break
+
+            slot, start, stop, first_seq, error, timings = done
+            n_rows = stop - start
+            if error is not None:
+                self.errors.append(error)
+            elif self.checkpoint is not None:
+                self.checkpoint.mark_done(first_seq, first_seq + n_rows)
+
+            for stage, seconds in timings.items():
+                self.metrics.observe(stage, seconds)
+
+            # Time from the page being ready for the model to its prediction being stored
+            now = time.perf_counter()
+            for ready_time in self.arena.ready_times[slot, start:stop]:
+                self.metrics.observe('page_latency', now - ready_time)
+
+            self.classified += n_rows
+            if self.progress is not None:
+                self.progress.update(n_rows)
+
+            # A slot can be reused once all of its rows have been classified
+            self.rows_done[slot] += n_rows
+            if self.rows_done[slot] == self.arena.batch_size:
+                self.rows_done[slot] = 0
+                self.arena.free_slots.put(slot)
+
+
+def classify_stream(model_factory, reader, predictions_array, n_spectra, batch_size=64,
+                    prefetch_pages=256, batch_timeout=0.5, input_dtype=np.uint8,
+                    workers=1, use_multiprocessing=False, num_dms=NUM_DMS, metrics=None, progress=None,
+                    first_page=0, checkpoint=None):
+    """
+    Classifies `n_spectra` pages from a DADA reader in batches.
+
+    A `PageReader` thread fills a `BatchArena` ahead of the model and the
+    filled rows are dispatched as work items to `workers` inference workers.
+    With `use_multiprocessing` the workers are separate processes, each with
+    its own copy of the model from `model_factory` and an equal share of the
+    CPU cores for TensorFlow; otherwise they are threads sharing one model.
+    If no page arrives for `batch_timeout` seconds, the rows of the current
+    slot collected so far are dispatched straight away so a partial batch is
+    never held back.
+
+    Every page keeps its sequence number, so predictions always land in the
+    same slot of `predictions_array` and, with batches made of the same
+    pages, the output is identical to a single-worker run. The prediction
+    of page `seq` of the stream is written to `first_page + seq`, so a
+    resumed stream continues where an earlier one stopped. The contiguous
+    prefix of written predictions is recorded in `checkpoint`, a
+    `ProgressCheckpoint`, which is saved once more at the end.
+
+    Pages are reshaped to `num_dms` DM trials. Per-stage latencies are
+    recorded in `metrics`, a `StageMetrics`.
+
+    Raises a RuntimeError if a worker exits before the end of the stream,
+    so a crashed inference process does not leave the stream waiting for
+    the slots it holds.
+
+    Returns the number of classified spectra.
+    """
+    workers = max(1, workers)
+    metrics = metrics if metrics is not None else StageMetrics()
+    n_slots = max(workers + 1, -(-prefetch_pages // batch_size))
+
+    if use_multiprocessing:
+        context = multiprocessing.get_context('spawn')
+        arena = SharedBatchArena(n_slots, batch_size, input_dtype)
+        work_queue = context.Queue()
+        done_queue = context.Queue()
+        intra_op_threads = max(1, (os.cpu_count() or 1) // workers)
+        pool = [
+            context.Process(
+                target=_process_worker,
+                args=(model_factory, predictions_array.filename, intra_op_threads, work_queue, done_queue),
+                daemon=True
+            )
+            for _ in range(workers)
+        ]
+    else:
+        arena = BatchArena(n_slots, batch_size, input_dtype)
+        work_queue = queue.Queue()
+        done_queue = queue.Queue()
+        model = model_factory()
+        pool = [
+            threading.Thread(
+                target=_worker_loop,
+                args=(model, lambda work: arena.images[work[0], work[1]:work[2]], work_queue, done_queue, predictions_array),
+                daemon=True
+            )
+            for _ in range(workers)
+        ]
+
+    def dispatch(slot, start, stop, first_seq):
+        work = (slot, start, stop, first_page + first_seq)
+        if use_multiprocessing:
+            work += (arena.descriptor(),)
+        work_queue.put(work)
+
+    for worker in pool:
+        worker.start()
+
+    collector = _Collector(arena, done_queue, metrics, progress, checkpoint)
+    collector.start()
+
+    page_reader = PageReader(reader, n_spectra, arena, num_dms=num_dms, metrics=metrics)
+    page_reader.start()
+
+    slot = None        # Slot currently being filled by the reader
+    first_seq = 0      # Sequence number of the first row of that slot
+    start = stop = 0   # Rows [start, stop) of the slot are waiting to be dispatched
+    try:
+        while True:
+            try:
+                item = page_reader.ready.get(timeout=batch_timeout)
+            except queue.Empty:
+                # Nothing moves while a dead worker holds slots, so make sure they are all alive
+                _check_workers(pool)
+
+                # The stream has stalled: dispatch whatever is waiting
+                if stop > start:
+                    dispatch(slot, start, stop, first_seq + start)
+                    start = stop
+                continue
+
+            if item is _END_OF_STREAM:
+                break
+
+            slot, row, seq = item
+            if row == 0:
+                first_seq = seq
+                start = 0
+            stop = row + 1
+
+            if stop == batch_size:
+                dispatch(slot, start, stop, first_seq + start)
+                start = stop = 0
+
+        # Dispatch the remaining partial batch at the end of the stream
+        if stop > start:
+            dispatch(slot, start, stop, first_seq + start)
+
+        page_reader.join()
+    finally:
+        for _ in pool:
+            work_queue.put(_END_OF_STREAM)
+        for worker in pool:
+            worker.join()
+        # A worker process that crashed has not reported the items it was given
+        failed_workers = [
+            f"{worker.name} (exit code {worker.exitcode})" for worker in pool if getattr(worker, 'exitcode', 0)
+        ]
+
+        done_queue.put(_END_OF_STREAM)
+        collector.join()
+        arena.close()
+        if checkpoint is not None:
+            checkpoint.save()
+
+    if page_reader.error is not None:
+        raise page_reader.error
+    if failed_workers:
+        raise RuntimeError(f"Inference workers exited before the end of the stream: {', '.join(failed_workers)}")
+    if collector.errors:
+        raise RuntimeError(f"Inference worker failed:\n{collector.errors[0]}")
+
+    return collector.classified
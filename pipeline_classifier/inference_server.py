@@ -0,0 +1,136 @@
+import os
+import time
+import socket
+import argparse
+import threading
+import traceback
+import numpy as np
+
+from utils import load_config
+from engines import load_classifier
+from inference import NUM_DMS
+from job_queue import JobQueue
+from archive import RecordingReader, ArchiveReader
+from run_inference import open_predictions, classify_observation
+
+
+def warm_up(model, config):
+    """
+    Runs one batch through the model, so the first page of the first job
+    does not pay for graph tracing and memory allocation.
+    """
+    images = np.zeros((config.get("batch_size", 64), NUM_DMS, NUM_DMS, 1), dtype=config.get("input_dtype", "uint8"))
+    model(images, training=False)
+
+
+def run_job(config, model, job):
+    """
+    Classifies the stream of one job with the loaded model.
+
+    A job gives the hexadecimal DADA `key` of the DM-time ring buffer and
+    `n_spectra`, or instead the `replay` path of an archive written with
+    `record`, the `output` predictions file and optionally the `filterbank`
+    name for the metrics, `resume` and a `record` archive path.
+    """
+    if job.get('resume') and job.get('record'):
+        raise ValueError("A resumed job cannot be recorded")
+
+    name_of_the_set = job.get('filterbank', job['id']).split('.')[0]
+    if job.get('replay'):
+        reader = ArchiveReader(job['replay'])
+        predictions_array, first_page = open_predictions(job['output'], len(reader), job.get('resume', False))
+        reader.seek(first_page)
+    else:
+        from psrdada import Reader
+
+        predictions_array, first_page = open_predictions(job['output'], job['n_spectra'], job.get('resume', False))
+        reader = Reader(int(str(job['key']), 16))
+        if job.get('record'):
+            reader = RecordingReader(reader, job['record'], job['n_spectra'], metadata={'filterbank': job.get('filterbank')})
+
+    return classify_observation(config, lambda: model, reader, predictions_array, first_page, name_of_the_set)
+
+
+class Heartbeat(threading.Thread):
+    """
+    Background thread that marks the server, and the job it is running, as
+    alive in the queue every `interval` seconds, also while a job blocks the
+    main thread.
+    """
+    def __init__(self, queue, server_id, interval):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.server_id = server_id
+        self.interval = interval
+        self.job_id = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.queue.heartbeat(self.server_id, self.job_id)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.queue.remove_server(self.server_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm inference service classifying the jobs of a queue directory')
+    parser.add_argument('-c', '--config', type=str, required=True, help='Config file with the model and batching settings')
+    parser.add_argument('--queue-dir', type=str, default=None, help='Queue directory (default: inference_server_queue of the config)')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between looks at the queue')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    queue = JobQueue(args.queue_dir or config.get("inference_server_queue") or "inference_queue/")
+
+    # The inference workers of every job are threads sharing the one warm model
+    if config.get("use_multiprocessing"):
+        print('use_multiprocessing is ignored: worker processes would have to load the model for every job')
+    config = dict(config, use_multiprocessing=False)
+
+    t0 = time.perf_counter()
+    model = load_classifier(config)
+    warm_up(model, config)
+    print(f'Model loaded and warmed up in {time.perf_counter() - t0:.1f} s, watching {queue.queue_dir}')
+
+    # Submitters give up on a job after `stale_after` seconds without a heartbeat;
+    # jobs left behind by a server that died are recovered after twice that
+    heartbeat = Heartbeat(queue, f'{socket.gethostname()}_{os.getpid()}', config.get("inference_server_heartbeat", 5.0))
+    heartbeat.start()
+    orphan_age = 2 * config.get("inference_server_stale_after", 30.0)
+
+    try:
+        while True:
+            requeued, failed = queue.recover_orphans(orphan_age)
+            for job_id in requeued:
+                print(f'Requeued job {job_id} of a server that stopped')
+            for job_id in failed:
+                print(f'Failed stream job {job_id} of a server that stopped')
+
+            job = queue.claim()
+            if job is None:
+                time.sleep(args.poll_interval)
+                continue
+
+            print(f"Job {job['id']}: {job['n_spectra']} pages from key {job['key']} to {job['output']}")
+            heartbeat.job_id = job['id']
+            t0 = time.perf_counter()
+            try:
+                classified = run_job(config, model, job)
+            except Exception:
+                queue.finish(job, 'failed', error=traceback.format_exc(), elapsed_s=time.perf_counter() - t0)
+                print(f"Job {job['id']} failed")
+            else:
+                queue.finish(job, 'done', classified=classified, elapsed_s=time.perf_counter() - t0)
+                print(f"Job {job['id']} done: {classified} pages in {time.perf_counter() - t0:.1f} s")
+            finally:
+                heartbeat.job_id = None
+    finally:
+        heartbeat.stop()
+
+
+if __name__ == "__main__":
+    main()
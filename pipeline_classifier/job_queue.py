@@ -0,0 +1,232 @@
+import os
+import json
+import time
+
+from checkpoint import load_checkpoint
+
+STATES = ('pending', 'running', 'done', 'failed')
+
+
+class JobQueue:
+    """
+    Directory-based queue of inference jobs shared by `run_pipeline.py` and
+    `inference_server.py`.
+
+    Every job is a JSON file that moves through the subdirectories
+    `pending/`, `running/` and `done/` or `failed/` of the queue directory.
+    Every move is a rename within one file system, so a job is never seen
+    half-written and is claimed by exactly one server, even with several
+    servers watching the same queue.
+
+    Servers show that they are alive with heartbeats: every server touches
+    its file in `servers/` and the file of the job it is running at regular
+    intervals. A running job whose file has not been touched for a while
+    belongs to a server that died; it is failed by a waiting submitter, or
+    recovered by the next server that looks at the queue. Only jobs that
+    replay an archive can be run again; the pages a dead server read from a
+    live ring buffer are gone, so its stream jobs are failed.
+    """
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        for state in (*STATES, 'servers'):
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+    def _path(self, state, job_id):
+        return os.path.join(self.queue_dir, state, f'{job_id}.json')
+
+    def _jobs(self, state):
+        names = sorted(os.listdir(os.path.join(self.queue_dir, state)))
+        return [name[:-len('.json')] for name in names if name.endswith('.json') and not name.startswith('.')]
+
+    def submit(self, job, name='job'):
+        """
+        Adds a job to the queue and returns its id. Ids start with the
+        submission time, so jobs are served in submission order.
+        """
+        job_id = f'{time.time_ns()}_{name}'
+        tmp_path = os.path.join(self.queue_dir, f'.{job_id}.json.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(dict(job, id=job_id), file, indent=4)
+        os.replace(tmp_path, self._path('pending', job_id))
+        return job_id
+
+    def claim(self):
+        """
+        Moves the oldest pending job to `running/` and returns it, or returns
+        None if no job is pending.
+        """
+        for job_id in self._jobs('pending'):
+            try:
+                os.replace(self._path('pending', job_id), self._path('running', job_id))
+            except FileNotFoundError:
+                continue  # Claimed by another server in the meantime
+            # The first heartbeat of the job, its file still has the submission time
+            os.utime(self._path('running', job_id))
+            with open(self._path('running', job_id), 'r') as file:
+                return json.load(file)
+        return None
+
+    def finish(self, job, status, **result):
+        """
+        Moves a running job to `done/` or `failed/` together with its result.
+        A job that was failed by its submitter in the meantime stays failed.
+        """
+        state = 'done' if status == 'done' else 'failed'
+        tmp_path = os.path.join(self.queue_dir, f'.{job["id"]}.json.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(dict(job, status=status, **result), file, indent=4)
+        try:
+            os.replace(self._path('running', job['id']), self._path(state, job['id']))
+        except FileNotFoundError:
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, self._path(state, job['id']))
+
+    def cancel(self, job_id, error):
+        """
+        Fails a pending or running job, so no server runs or finishes it, and
+        returns its final state.
+        """
+        for state in ('pending', 'running'):
+            try:
+                os.replace(self._path(state, job_id), self._path('failed', job_id))
+            except FileNotFoundError:
+                continue
+
+            with open(self._path('failed', job_id), 'r') as file:
+                job = json.load(file)
+            job.update(status='failed', error=error)
+            tmp_path = os.path.join(self.queue_dir, f'.{job_id}.json.tmp')
+            with open(tmp_path, 'w') as file:
+                json.dump(job, file, indent=4)
+            os.replace(tmp_path, self._path('failed', job_id))
+            return job
+        return None
+
+    def heartbeat(self, server_id, job_id=None):
+        """
+        Marks a server, and the job it is running, as alive.
+        """
+        with open(os.path.join(self.queue_dir, 'servers', server_id), 'w') as file:
+            file.write(f'{time.time()}\n')
+        if job_id is not None:
+            try:
+                os.utime(self._path('running', job_id))
+            except FileNotFoundError:
+                pass
+
+    def remove_server(self, server_id):
+        try:
+            os.remove(os.path.join(self.queue_dir, 'servers', server_id))
+        except FileNotFoundError:
+            pass
+
+    def live_servers(self, max_age):
+        """
+        Number of servers with a heartbeat in the last `max_age` seconds.
+        """
+        servers_dir = os.path.join(self.queue_dir, 'servers')
+        now = time.time()
+        alive = 0
+        for name in os.listdir(servers_dir):
+            try:
+                alive += now - os.path.getmtime(os.path.join(servers_dir, name)) <= max_age
+            except FileNotFoundError:
+                pass
+        return alive
+
+    def _age(self, state, job_id):
+        return time.time() - os.path.getmtime(self._path(state, job_id))
+
+    def recover_orphans(self, max_age):
+        """
+        Recovers running jobs without a heartbeat in the last `max_age`
+        seconds. Jobs replaying an archive go back to `pending/`, resuming
+        from the checkpoint of their predictions file if it has one, with the
+        attempt counted in `attempts`. Jobs classifying a live stream are
+        failed. Returns the ids of the requeued and of the failed jobs.
+        """
+        requeued, failed = [], []
+        for job_id in self._jobs('running'):
+            try:
+                if self._age('running', job_id) <= max_age:
+                    continue
+                # Take the job out of running/ first, so only one server recovers it
+                tmp_path = os.path.join(self.queue_dir, f'.{job_id}.json.requeue')
+                os.replace(self._path('running', job_id), tmp_path)
+            except FileNotFoundError:
+                continue
+
+            with open(tmp_path, 'r') as file:
+                job = json.load(file)
+            if job.get('replay'):
+                job['attempts'] = job.get('attempts', 0) + 1
+                job['resume'] = load_checkpoint(job['output']) is not None
+                state = 'pending'
+                requeued.append(job_id)
+            else:
+                job.update(status='failed', error=f'The inference server stopped without a heartbeat for {max_age} s; '
+                                                  f'the pages it read from the ring buffer are lost')
+                state = 'failed'
+                failed.append(job_id)
+
+            with open(tmp_path, 'w') as file:
+                json.dump(job, file, indent=4)
+            os.replace(tmp_path, self._path(state, job_id))
+        return requeued, failed
+
+    def wait(self, job_id, poll_interval=1.0, stale_after=30.0, timeout=None, progress=None, stall_after=None):
+        """
+        Blocks until a job is done or failed and returns its final state.
+
+        The job is failed instead if no server has been alive for
+        `stale_after` seconds while it is pending, if the server running it
+        has not sent a heartbeat for `stale_after` seconds, if it is not
+        finished after `timeout` seconds, or if `progress`, a callable
+        returning the progress of the job, such as the completed pages of its
+        checkpoint, has not changed for `stall_after` seconds while it runs.
+        A heartbeat only shows that the server is alive; the progress also
+        catches a server that is stuck, e.g. waiting for pages that never come.
+        """
+        start = time.time()
+        last_progress = None
+        last_advanced = None  # Time the job was seen running or its progress last changed
+        while True:
+            for state in ('done', 'failed'):
+                try:
+                    with open(self._path(state, job_id), 'r') as file:
+                        job = json.load(file)
+                except FileNotFoundError:
+                    continue
+                # The result is written right after the move, read it once it is there
+                if 'status' in job:
+                    return job
+
+            error = None
+            waited = time.time() - start
+            if timeout is not None and waited > timeout:
+                error = f'Not finished after {timeout} s'
+            elif os.path.exists(self._path('pending', job_id)):
+                if waited > stale_after and not self.live_servers(stale_after):
+                    error = f'No inference server alive in {self.queue_dir}'
+            else:
+                try:
+                    if self._age('running', job_id) > stale_after:
+                        error = f'The inference server sent no heartbeat for {stale_after} s'
+                except FileNotFoundError:
+                    pass  # Moving between states
+
+                if error is None and progress is not None and stall_after is not None:
+                    current = progress()
+                    if last_advanced is None or current != last_progress:
+                        last_progress, last_advanced = current, time.time()
+                    elif time.time() - last_advanced > stall_after:
+                        error = f'The job made no progress for {stall_after} s'
+
+            if error is not None:
+                job = self.cancel(job_id, error)
+                if job is not None:
+                    return job
+                continue  # Finished while being cancelled
+
+            time.sleep(poll_interval)
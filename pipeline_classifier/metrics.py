@@ -0,0 +1,124 @@
+import os
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class StageMetrics:
+    """
+    Thread-safe latency histograms per pipeline stage and gauges, rendered
+    in the Prometheus text exposition format.
+
+    All metric names are prefixed with `prefix`. Stage latencies are exported
+    as one histogram `<prefix>_stage_seconds` with a `stage` label.
+    """
+    def __init__(self, prefix='single_pulse', labels=None):
+        self.prefix = prefix
+        self.labels = dict(labels or {})
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._gauges = {}
+
+    def observe(self, stage, seconds):
+        """
+        Records one latency measurement of `stage`.
+        """
+        with self._lock:
+            if stage not in self._histograms:
+                self._histograms[stage] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+            histogram = self._histograms[stage]
+            for idx, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][idx] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Sets the current value of the gauge `<prefix>_<name>`.
+        """
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def _format_labels(self, **extra):
+        labels = {**self.labels, **extra}
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            if self._histograms:
+                name = f'{self.prefix}_stage_seconds'
+                lines.append(f'# HELP {name} Time spent in each pipeline stage.')
+                lines.append(f'# TYPE {name} histogram')
+                for stage, histogram in sorted(self._histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{self._format_labels(stage=stage, le=bound)} {cumulative}')
+                    lines.append(f'{name}_bucket{self._format_labels(stage=stage, le="+Inf")} {histogram["count"]}')
+                    lines.append(f'{name}_sum{self._format_labels(stage=stage)} {histogram["sum"]}')
+                    lines.append(f'{name}_count{self._format_labels(stage=stage)} {histogram["count"]}')
+
+            gauge_names = sorted({name for name, _ in self._gauges})
+            for gauge_name in gauge_names:
+                name = f'{self.prefix}_{gauge_name}'
+                lines.append(f'# TYPE {name} gauge')
+                for (key, labels), value in sorted(self._gauges.items()):
+                    if key == gauge_name:
+                        lines.append(f'{name}{self._format_labels(**dict(labels))} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes the metrics to `path` atomically, so a collector never sees a
+        partially written file.
+        """
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(self.render())
+        os.replace(tmp_path, path)
+
+
+class MetricsWriter(threading.Thread):
+    """
+    Background thread that writes `metrics` to `path` every `interval`
+    seconds, and once more when it is stopped.
+
+    `before_write`, if given, is called before every write, e.g. to refresh
+    gauges.
+    """
+    def __init__(self, metrics, path, interval=10.0, before_write=None):
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.before_write = before_write
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self._write()
+        self._write()
+
+    def _write(self):
+        try:
+            if self.before_write is not None:
+                self.before_write()
+            self.metrics.write(self.path)
+        except Exception as error:
+            print(f"Failed to write metrics to {self.path}: {error}")
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
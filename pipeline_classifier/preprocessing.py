@@ -0,0 +1,97 @@
+import numpy as np
+
+
+def normalize_into(images, out, scratch=None, flip=False):
+    """
+    Normalises images to the 0-255 range, each by its own minimum and maximum,
+    into the preallocated `out` array.
+
+    This is the single definition of the classifier input, shared by the
+    dataset creator (training data) and the inference pipeline (live pages),
+    so both produce bit-identical inputs for the same DM-time plane.
+
+    `images` is one image (dm, time) or a batch (n, dm, time). The values are
+    converted to float32 first, then every image is scaled as
+    `(image - min) / (max - min) * 255` in float32 and truncated to `out`,
+    exactly like `astype(np.uint8)`. The minimum and maximum of every image
+    are computed once, and all intermediate values live in `scratch`, so no
+    temporary arrays of the size of the batch are allocated.
+
+    Args:
+        images (numpy.ndarray): Image or batch of images; any real dtype, may be a strided view.
+        out (numpy.ndarray): Output of the same shape, integer (usually uint8) or floating point.
+        scratch (numpy.ndarray, optional): float32 array of the same shape for the intermediate
+            values; allocated if not given.
+        flip (bool): Reverse the DM axis (second to last) of the images, as done for every
+            DM-time plane before it is classified.
+
+    Returns:
+        numpy.ndarray: `out`.
+    """
+    if flip:
+        images = images[..., ::-1, :]
+    if scratch is None:
+        scratch = np.empty(images.shape, dtype=np.float32)
+
+    # Convert once, so the reductions and the scaling all run in float32
+    if images.dtype != np.float32:
+        np.copyto(scratch, images, casting='same_kind')
+        images = scratch
+
+    images_min = images.min(axis=(-2, -1), keepdims=True)
+    images_max = images.max(axis=(-2, -1), keepdims=True)
+    np.subtract(images, images_min, out=scratch)
+    np.divide(scratch, images_max - images_min, out=scratch)
+    np.multiply(scratch, 255, out=scratch)
+
+    if np.issubdtype(out.dtype, np.integer):
+        # Float to integer conversion truncates, exactly like astype(np.uint8)
+        np.copyto(out, scratch, casting='unsafe')
+    else:
+        np.trunc(scratch, out=out)
+
+    return out
+
+
+def normalize(images, flip=False):
+    """
+    Normalises an image or a batch of images to a new uint8 array, see `normalize_into`.
+    """
+    out = np.empty(images.shape, dtype=np.uint8)
+    return normalize_into(images, out, flip=flip)
+
+
+def downsample(images, resolution):
+    """
+    Downsample a batch of uint8 images to `resolution` x `resolution` by block averaging.
+
+    Every output pixel is the mean of its block of input pixels, rounded like
+    `cv2.resize(image, (resolution, resolution), interpolation=cv2.INTER_AREA)`:
+    half up for 2x2 blocks, which OpenCV averages in integer arithmetic, and
+    half to even for larger blocks. The result is identical to OpenCV's, so a
+    lower resolution can be derived from the 256x256 images instead of being
+    stored as a dataset of its own.
+
+    Args:
+        images (numpy.ndarray): uint8 batch of shape (n_images, height, width).
+        resolution (int): Output height and width; must divide height and width.
+
+    Returns:
+        numpy.ndarray: uint8 batch of shape (n_images, resolution, resolution).
+
+    Raises:
+        ValueError: If the image size is not a multiple of the resolution.
+    """
+    n_images, height, width = images.shape
+    if height % resolution or width % resolution:
+        raise ValueError(f"Images of {height}x{width} cannot be block-averaged to {resolution}x{resolution}")
+    if (height, width) == (resolution, resolution):
+        return images
+
+    block_height, block_width = height // resolution, width // resolution
+    area = block_height * block_width
+    blocks = images.reshape(n_images, resolution, block_height, resolution, block_width)
+    sums = blocks.sum(axis=(2, 4), dtype=np.uint32)
+    if area == 4:
+        return ((sums + area // 2) // area).astype(np.uint8)
+    return np.rint(sums / area).astype(np.uint8)
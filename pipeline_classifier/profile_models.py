@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+from utils import load_config, spectra_per_page
+
+TRAINING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'single_pulse_classifier_training')
+RESOLUTIONS = (256, 128, 64, 32)
+THREAD_COUNTS = (1, 2, 4, 8)
+
+
+def build_model(model_name, resolution):
+    """
+    Builds an untrained model from `training_models.models_htable`; the
+    weights do not change its size or the cost of a forward pass.
+    """
+    sys.path.insert(0, TRAINING_DIR)
+    from training_models import models_htable
+    return models_htable[model_name](resolution)
+
+
+def count_flops(model):
+    """
+    Analytic floating point operations of one forward pass of one image.
+
+    A multiply-accumulate counts as two operations; every pooling window
+    element counts as one comparison. Activations and biases are ignored.
+    """
+    from tensorflow.keras import layers
+
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, layers.Conv2D):
+            kernel_h, kernel_w, channels_in, channels_out = layer.kernel.shape
+            _, out_h, out_w, _ = layer.output.shape
+            flops += 2 * kernel_h * kernel_w * channels_in * channels_out * out_h * out_w
+        elif isinstance(layer, layers.Dense):
+            units_in, units_out = layer.kernel.shape
+            flops += 2 * units_in * units_out
+        elif isinstance(layer, layers.MaxPooling2D):
+            _, out_h, out_w, channels = layer.output.shape
+            flops += out_h * out_w * channels * layer.pool_size[0] * layer.pool_size[1]
+    return int(flops)
+
+
+def measure_latency(model, batch, repeats):
+    """
+    Mean latency in seconds of one forward pass of `batch`, after a warm-up pass.
+    """
+    model(batch, training=False)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model(batch, training=False)
+    return (time.perf_counter() - start) / repeats
+
+
+def run_one(model_name, resolution, threads, batch_size, repeats):
+    """
+    Profiles one model/resolution combination with `threads` TensorFlow
+    threads. Runs in its own process, as the thread pools of TensorFlow can
+    only be set before its first operation.
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+    model = build_model(model_name, resolution)
+    images = np.random.default_rng(42).integers(0, 256, size=(batch_size, resolution, resolution, 1)).astype(np.float32)
+
+    image_latency = measure_latency(model, images[:1], repeats)
+    batch_latency = measure_latency(model, images, repeats)
+    return {
+        'model': model_name,
+        'resolution': resolution,
+        'threads': threads,
+        'parameters': int(model.count_params()),
+        'flops': count_flops(model),
+        'latency_per_image_ms': image_latency * 1000,
+        'latency_per_batch_ms': batch_latency * 1000,
+        'batch_size': batch_size,
+        'images_per_second': batch_size / batch_latency
+    }
+
+
+def real_time_budget(config, nbits, nchans, tsamp):
+    """
+    Time span in seconds of the data in one ring buffer block, which is the
+    time the classifier has for the DM-time page of that block.
+
+    A block of `input_buffer_size` bytes holds `input_buffer_size * 8 / (nbits * nchans)`
+    spectra, sampled every `tsamp` seconds. Downsampling in TransientX only
+    changes the number of samples of the page, not the time the block covers.
+    """
+    return spectra_per_page(config, nbits, nchans) * tsamp
+
+
+def filterbank_parameters(config, args):
+    """
+    (nbits, nchans, tsamp) from the command line, or from the header of the
+    filterbank file of the configuration.
+    """
+    if args.nbits and args.nchans and args.tsamp:
+        return args.nbits, args.nchans, args.tsamp
+
+    import your
+    header = your.Your(os.path.join(config["path_to_filterbanks"], config["name_of_the_filterbank"])).your_header
+    return args.nbits or header.nbits, args.nchans or header.nchans, args.tsamp or header.tsamp
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Size, FLOPs and CPU latency of the classifiers against the real-time budget')
+    parser.add_argument('-c', '--config', type=str, default='config.json', help='Pipeline config file')
+    parser.add_argument('--models', nargs='+', default=None, help='Models from models_htable (default: all)')
+    parser.add_argument('--resolutions', nargs='+', type=int, default=list(RESOLUTIONS))
+    parser.add_argument('--threads', nargs='+', type=int, default=list(THREAD_COUNTS))
+    parser.add_argument('--batch-size', type=int, default=None, help='Batch size (default: batch_size of the config)')
+    parser.add_argument('--repeats', type=int, default=20, help='Forward passes averaged per measurement')
+    parser.add_argument('--nbits', type=int, default=None, help='Bits per sample (default: from the filterbank header)')
+    parser.add_argument('--nchans', type=int, default=None, help='Number of channels (default: from the filterbank header)')
+    parser.add_argument('--tsamp', type=float, default=None, help='Sampling time in seconds (default: from the filterbank header)')
+    parser.add_argument('-o', '--output', type=str, default='model_profile.json')
+    parser.add_argument('--run-one', nargs=3, metavar=('MODEL', 'RESOLUTION', 'THREADS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    batch_size = args.batch_size or config.get("batch_size", 64)
+
+    if args.run_one:
+        # Single combination, run in its own process so its thread pools can be set
+        model_name, resolution, threads = args.run_one
+        print(json.dumps(run_one(model_name, int(resolution), int(threads), batch_size, args.repeats)))
+        return
+
+    nbits, nchans, tsamp = filterbank_parameters(config, args)
+    budget = real_time_budget(config, nbits, nchans, tsamp)
+    print(f'Real-time budget: {budget * 1000:.3f} ms per page '
+          f'({config["input_buffer_size"]} byte blocks, {nbits} bits, {nchans} channels, tsamp {tsamp} s)')
+
+    if args.models is None:
+        sys.path.insert(0, TRAINING_DIR)
+        from training_models import models_htable
+        args.models = list(models_htable)
+
+    results = []
+    for model_name in args.models:
+        for resolution in args.resolutions:
+            for threads in args.threads:
+                command = [
+                    sys.executable, os.path.abspath(__file__), '-c', args.config,
+                    '--run-one', model_name, str(resolution), str(threads),
+                    '--batch-size', str(batch_size), '--repeats', str(args.repeats)
+                ]
+                output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout.decode()
+                result = json.loads(output.strip().splitlines()[-1])
+
+                # Pages arrive every `budget` seconds and are classified in batches
+                seconds_per_page = result['latency_per_batch_ms'] / 1000 / batch_size
+                result['budget_ms'] = budget * 1000
+                result['real_time_factor'] = seconds_per_page / budget
+                result['real_time'] = seconds_per_page <= budget
+                results.append(result)
+
+                print(f"{model_name} {resolution}x{resolution} {threads} threads: "
+                      f"{result['parameters']} params, {result['flops'] / 1e6:.1f} MFLOPs, "
+                      f"{result['latency_per_image_ms']:.2f} ms/image, {result['latency_per_batch_ms']:.2f} ms/batch, "
+                      f"{result['real_time_factor']:.3f} x real time{'' if result['real_time'] else ' (TOO SLOW)'}")
+
+    with open(args.output, 'w') as file:
+        json.dump({'budget_ms': budget * 1000, 'batch_size': batch_size, 'results': results}, file, indent=4)
+    print(f'Profile saved to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,79 +1,158 @@
 import os
 import argparse
+import functools
 import numpy as np
-import tensorflow as tf
-from tqdm import trange
-from tensorflow.keras.models import load_model
-from psrdada import Reader
-from utils import load_config, normalize_image_to_255
-
-# Set up argument parser to accept configuration file path
-parser = argparse.ArgumentParser(description="Inference pipeline")
-parser.add_argument('-c', '--config', type=str, required=True, 
-                   help="Path to configuration file")
-args = parser.parse_args()
-
-# Load configuration parameters from specified file
-config = load_config(args.config)
-
-# Load pre-trained model from specified path
-model = load_model(f'{config["path_to_models"]}{config["name_of_the_model"]}')
-
-# Initialize DADA reader with hexadecimal key from config
-reader = Reader(int(str(config["key_output"]), 16))
-
-# Generate output filename by removing extension from filterbank name
-output_filename = f"predictions_{config['name_of_the_filterbank'].split('.')[0]}.npy"
-
-# Create memory-mapped array for efficient disk-backed storage
-# This allows incremental saving without loading full array in memory
-predictions_array = np.lib.format.open_memmap(
-    output_filename,       # Output file path
-    dtype=np.int32,          # Data type (can handle variable-length sequences)
-    mode='w+',             # Read/write mode, creates new file
-    shape=(config["n_spectra"],)  # Pre-allocate array size
-)
-
-# Process each spectrum in the input data
-for i in trange(config["n_spectra"]):
-    # Get next data page from DADA buffer
-    page = reader.getNextPage()
-    
-    # Convert raw bytes to float32 numpy array
-    data = np.frombuffer(page, dtype=np.float32)
-    
-    # Calculate dimensions for reshaping
-    total_size = data.size
-    num_dms = 256          # Fixed number of DM trials
-    num_dumps = total_size // num_dms
-    
-    # Reshape 1D array into 2D (DM trials × time samples)
-    data = data.reshape((num_dms, num_dumps))
-    
-    # Normalize and flip the image vertically
-    normalized_image = normalize_image_to_255(data[::-1])
-    
-    # Add batch and channel dimensions for model input
-    reshaped_data = normalized_image.reshape(1, *normalized_image.shape, 1)
-    
-    # Run model inference (disable training-specific ops)
-    prediction = model(reshaped_data, training=False)
-    
-    # Get class with highest probability
-    max_index = tf.argmax(prediction, axis=-1)
-    
-    # Store prediction in memory-mapped array
-    predictions_array[i] = int(max_index.numpy()[0])
-    
-    # Mark buffer page as processed
-    reader.markCleared()
-    
-    # Periodically flush writes to disk (every 100 spectra)
-    if (i + 1) % 100 == 0:
+from tqdm import tqdm
+from utils import load_config
+from inference import classify_stream
+from engines import load_classifier
+from archive import RecordingReader, ArchiveReader
+from checkpoint import ProgressCheckpoint, load_checkpoint
+from metrics import StageMetrics, MetricsWriter
+
+
+def open_predictions(output_filename, n_spectra, resume=False):
+    """
+    Opens the predictions file of a run as a memmap of `n_spectra` entries.
+
+    A new file is created together with a checkpoint of no completed pages,
+    unless `resume` is set: then the existing file is continued after the
+    pages completed according to its checkpoint.
+    Returns the memmap and the first page that still has to be classified.
+    """
+    if not resume:
+        # Create memory-mapped array for efficient disk-backed storage
+        # This allows incremental saving without loading full array in memory
+        predictions_array = np.lib.format.open_memmap(
+            output_filename,       # Output file path
+            dtype=np.int32,          # Data type (can handle variable-length sequences)
+            mode='w+',             # Read/write mode, creates new file
+            shape=(n_spectra,)  # Pre-allocate array size
+        )
+
+        # Replace the checkpoint of an earlier run right away, so a crash before
+        # the first batch never resumes from its stale progress
+        ProgressCheckpoint(output_filename, n_spectra).save()
+        return predictions_array, 0
+
+    # Continue in the existing predictions file after its last completed page;
+    # the stream now starts with that page
+    checkpoint = load_checkpoint(output_filename)
+    if checkpoint is None:
+        raise ValueError(f"No checkpoint found for {output_filename}")
+    predictions_array = np.load(output_filename, mmap_mode='r+')
+    if len(predictions_array) != n_spectra:
+        raise ValueError(f"{output_filename} holds {len(predictions_array)} predictions, expected {n_spectra}")
+    print(f"Resuming {output_filename} after {checkpoint['completed']} of {n_spectra} pages")
+    return predictions_array, checkpoint['completed']
+
+
+def classify_observation(config, model_factory, reader, predictions_array, first_page, name_of_the_set):
+    """
+    Classifies the pages of `reader` into `predictions_array` from
+    `first_page` on, with progress checkpoints and stage metrics, and
+    disconnects the reader at the end. Returns the number of classified pages.
+    """
+    n_spectra = len(predictions_array)
+
+    # Contiguous prefix of final predictions, so a crashed run can be resumed
+    checkpoint = ProgressCheckpoint(predictions_array.filename, n_spectra, completed=first_page,
+                                    interval=config.get("checkpoint_interval", 1.0))
+
+    # Per-stage latencies are exported periodically in the Prometheus text format
+    metrics = StageMetrics(prefix='single_pulse_inference', labels={'filterbank': name_of_the_set})
+    metrics_dir = config.get("path_to_metrics", "metrics/")
+    os.makedirs(metrics_dir, exist_ok=True)
+    metrics_writer = MetricsWriter(
+        metrics,
+        os.path.join(metrics_dir, f'inference_{name_of_the_set}.prom'),
+        interval=config.get("metrics_interval", 10)
+    )
+    metrics_writer.start()
+
+    # Classify the whole stream in batches while pages are prefetched into a reused arena
+    try:
+        with tqdm(total=n_spectra, initial=first_page) as progress:
+            classified = classify_stream(
+                model_factory,
+                reader,
+                predictions_array,
+                n_spectra - first_page,
+                batch_size=config.get("batch_size", 64),
+                prefetch_pages=config.get("prefetch_pages", 256),
+                batch_timeout=config.get("batch_timeout", 0.5),
+                input_dtype=config.get("input_dtype", "uint8"),
+                workers=config.get("workers_for_tensorflow", 1),
+                use_multiprocessing=config.get("use_multiprocessing", False),
+                metrics=metrics,
+                progress=progress,
+                first_page=first_page,
+                checkpoint=checkpoint
+            )
+    finally:
+        metrics_writer.stop()
+
+        # Final flush to ensure all data is written
         predictions_array.flush()
 
-# Final flush to ensure all data is written
-predictions_array.flush()
+        # Clean up DADA reader connection
+        reader.disconnect()
+
+    return classified
+
+
+def main():
+    # Set up argument parser to accept configuration file path
+    parser = argparse.ArgumentParser(description="Inference pipeline")
+    parser.add_argument('-c', '--config', type=str, required=True,
+                       help="Path to configuration file")
+    parser.add_argument('--record', type=str, default=None,
+                       help="Also write every DM-time page read from the ring buffer to this archive (.npy)")
+    parser.add_argument('--replay', type=str, default=None,
+                       help="Classify the pages of an archive written with --record instead of the ring buffer")
+    parser.add_argument('--output', type=str, default=None,
+                       help="Predictions file (default: predictions_<filterbank>.npy)")
+    parser.add_argument('--resume', action='store_true',
+                       help="Continue the predictions file after the pages completed according to its checkpoint")
+    args = parser.parse_args()
+    if args.resume and args.record:
+        parser.error("--record cannot be combined with --resume")
+
+    # Load configuration parameters from specified file
+    config = load_config(args.config)
+
+    # Pre-trained model (Keras or int8 engine) is loaded by every inference worker
+    model_factory = functools.partial(load_classifier, config)
+
+    name_of_the_set = config['name_of_the_filterbank'].split('.')[0]
+    n_spectra = config["n_spectra"]
+    if args.replay:
+        # Pages come from a recorded archive, no ring buffer or TransientX needed
+        try:
+            reader = ArchiveReader(args.replay)
+        except ValueError as error:
+            parser.error(str(error))
+        n_spectra = len(reader)
+
+    # Generate output filename by removing extension from filterbank name
+    output_filename = args.output or f"predictions_{name_of_the_set}.npy"
+    try:
+        predictions_array, first_page = open_predictions(output_filename, n_spectra, args.resume)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.replay:
+        reader.seek(first_page)
+    else:
+        from psrdada import Reader
+
+        # Initialize DADA reader with hexadecimal key from config
+        reader = Reader(int(str(config["key_output"]), 16))
+        if args.record:
+            reader = RecordingReader(reader, args.record, n_spectra, metadata={'filterbank': config['name_of_the_filterbank']})
+
+    classify_observation(config, model_factory, reader, predictions_array, first_page, name_of_the_set)
+
 
-# Clean up DADA reader connection
-reader.disconnect()
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,45 @@
 import subprocess
 import argparse
 import os
+import sys
 
-from utils import run_command, create_buffer, kill_buffer, load_config, kill_dada_dbdedispdb, kill_dada_fildb
+from utils import run_command, create_buffer, kill_buffer, load_config, kill_dada_dbdedispdb, kill_dada_fildb, get_buffer_fill, spectra_per_page
+from metrics import StageMetrics, MetricsWriter
+from checkpoint import load_checkpoint
+from job_queue import JobQueue
+from filterbank import read_header, write_truncated_filterbank
 
 parser = argparse.ArgumentParser(description='Bowtie recognition pipline')
 parser.add_argument('-c', '--config', type=str, required=True, help='Config file')
+parser.add_argument('--record', type=str, default=None, help='Record the DM-time pages to this archive for replay (inside the working directory)')
+parser.add_argument('--resume', action='store_true', help='Continue an interrupted run from its last checkpointed page')
 
 args = parser.parse_args()
     
 name_of_config = os.path.splitext(os.path.basename(args.config))[0]
 config = load_config(args.config)
+name_of_the_set = config['name_of_the_filterbank'].split('.')[0]
+filterbank_path = f'{config["path_to_filterbanks"]}{config["name_of_the_filterbank"]}'
 
+# 0. Resuming: the filterbank is streamed from the first page without a final prediction
+if args.resume:
+    checkpoint = load_checkpoint(f'predictions_{name_of_the_set}.npy')
+    if checkpoint is None:
+        parser.error(f'No checkpoint found for predictions_{name_of_the_set}.npy')
+    if checkpoint['completed'] >= config['n_spectra']:
+        print(f'All {config["n_spectra"]} pages of {name_of_the_set} are already classified.')
+        raise SystemExit(0)
+
+    header, _, _ = read_header(filterbank_path)
+    start_sample = checkpoint['completed'] * spectra_per_page(config, header['nbits'], header['nchans'])
+
+    # dada_fildb streams whole files, so the remaining spectra are written to a file of their own
+    resume_dir = config.get("path_to_resume_filterbanks", "resume/")
+    os.makedirs(resume_dir, exist_ok=True)
+    resume_path = os.path.join(resume_dir, f'{name_of_the_set}_from_{start_sample}.fil')
+    write_truncated_filterbank(filterbank_path, resume_path, start_sample)
+    filterbank_path = resume_path
+    print(f'Resuming {name_of_the_set} at page {checkpoint["completed"]} (spectrum {start_sample})')
 
 
 # 1. Creating buffers
@@ -20,7 +48,7 @@ create_buffer(config['path_to_pulsarx_singularity_image'], buffer_size=config['i
 
 # 2. Running fildb and dbdedispdb
 commands = [
-    f'singularity exec -B $PWD -B {config["path_to_filterbanks"]} {config["path_to_pulsarx_singularity_image"]} dada_fildb --key_output {config["key_input"]} -f {config["path_to_filterbanks"]}{config["name_of_the_filterbank"]}',
+    f'singularity exec -B $PWD -B {config["path_to_filterbanks"]} {config["path_to_pulsarx_singularity_image"]} dada_fildb --key_output {config["key_input"]} -f {filterbank_path}',
     f'singularity exec -B $PWD {config["path_to_pulsarx_singularity_image"]} dada_dbdedispdb --key_input {config["key_input"]} --key_output {config["key_output"]} -c {config["path_to_a_transientx_config"]} -t {config["threads_for_transientx"]}'
 ]
 
@@ -29,9 +57,60 @@ for command in commands:
     run_command(command, wait=False)
     
 
-# 3. Running run_inference.py and waiting for it to finish
-tensorflow_inference_command = f'singularity exec -B $PWD -B {config["path_to_models"]} {config["path_to_tensorflow_psrdada_singularity_image"]} python3 run_inference.py -c {args.config}'
-run_command(tensorflow_inference_command, wait=True)
+# Fill levels of both ring buffers are exported periodically: a full output buffer
+# means the classifier is the bottleneck, a full input buffer with an empty output
+# buffer means the dedispersion is
+buffer_metrics = StageMetrics(prefix='single_pulse_pipeline', labels={'filterbank': name_of_the_set})
+
+def update_buffer_fill():
+    for buffer_name in ('key_input', 'key_output'):
+        fill = get_buffer_fill(config['path_to_pulsarx_singularity_image'], config[buffer_name])
+        if fill is not None:
+            full_blocks, total_blocks = fill
+            buffer_metrics.set_gauge('buffer_full_blocks', full_blocks, buffer=buffer_name)
+            buffer_metrics.set_gauge('buffer_total_blocks', total_blocks, buffer=buffer_name)
+            buffer_metrics.set_gauge('buffer_fill_ratio', full_blocks / total_blocks if total_blocks else 0.0, buffer=buffer_name)
+
+os.makedirs(config.get("path_to_metrics", "metrics/"), exist_ok=True)
+buffer_metrics_writer = MetricsWriter(
+    buffer_metrics,
+    os.path.join(config.get("path_to_metrics", "metrics/"), f'buffers_{name_of_the_set}.prom'),
+    interval=config.get("metrics_interval", 10),
+    before_write=update_buffer_fill
+)
+buffer_metrics_writer.start()
+
+# 3. Classifying the DM-time pages and waiting for it to finish
+inference_failed = False
+if config.get("inference_server_queue"):
+    # A running inference_server.py with the model already loaded takes the job
+    job = {
+        'key': config['key_output'],
+        'n_spectra': config['n_spectra'],
+        'output': os.path.abspath(f'predictions_{name_of_the_set}.npy'),
+        'filterbank': config['name_of_the_filterbank'],
+        'resume': args.resume,
+        'record': os.path.abspath(args.record) if args.record else None
+    }
+    job_queue = JobQueue(config["inference_server_queue"])
+    job_id = job_queue.submit(job, name=name_of_the_set)
+    print(f'Submitted job {job_id} to the inference server')
+    # A job whose checkpoint stops advancing is failed, even while the server sends heartbeats
+    result = job_queue.wait(job_id, stale_after=config.get("inference_server_stale_after", 30.0),
+                            timeout=config.get("inference_server_timeout"),
+                            progress=lambda: (load_checkpoint(job['output']) or {}).get('completed'),
+                            stall_after=config.get("inference_server_stall_after", 300.0))
+    if result['status'] != 'done':
+        print(f'Inference job {job_id} failed:\n{result.get("error")}')
+        inference_failed = True
+else:
+    tensorflow_inference_command = f'singularity exec -B $PWD -B {config["path_to_models"]} {config["path_to_tensorflow_psrdada_singularity_image"]} python3 run_inference.py -c {args.config}'
+    if args.record:
+        tensorflow_inference_command += f' --record {args.record}'
+    if args.resume:
+        tensorflow_inference_command += ' --resume'
+    run_command(tensorflow_inference_command, wait=True)
+buffer_metrics_writer.stop()
 
 
 # 4. Killing proceses
@@ -41,4 +120,7 @@ kill_dada_fildb(config['key_input'])
 kill_buffer(config['path_to_pulsarx_singularity_image'], config['key_input'])
 kill_buffer(config['path_to_pulsarx_singularity_image'], config['key_output'])
 
+if inference_failed:
+    sys.exit(1)
+
 print('All commands have been executed.')
@@ -0,0 +1,91 @@
+"""
+Golden tests: training-time and inference-time inputs must be bit-identical.
+
+The fixture freezes float32 and float64 DM-time planes together with the
+uint8 images the original per-image formula produced for them, with and
+without flipping the DM axis. Every normalisation path has to reproduce
+exactly those bytes.
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+import preprocessing
+from utils import normalize_image_into
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATASET_CREATOR_DIR = os.path.join(HERE, '..', 'DM_time_dataset_creator')
+GOLDEN = np.load(os.path.join(HERE, 'test_data', 'preprocessing_golden.npz'))
+
+CASES = [(dtype, flip) for dtype in ('float32', 'float64') for flip in (False, True)]
+
+
+def case(dtype, flip):
+    planes = GOLDEN[f'planes_{dtype}']
+    expected = GOLDEN[f'expected_{dtype}_flipped' if flip else f'expected_{dtype}']
+    return planes, expected
+
+
+def legacy_normalize(image):
+    # The original formula of the dataset creator, which cast to float32 first
+    image = image.astype(np.float32)
+    return ((image - np.min(image)) / (np.max(image) - np.min(image)) * 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize('dtype, flip', CASES)
+def test_legacy_formula(dtype, flip):
+    planes, expected = case(dtype, flip)
+    for plane, image in zip(planes, expected):
+        assert legacy_normalize(plane[::-1] if flip else plane).tobytes() == image.tobytes()
+
+
+@pytest.mark.parametrize('dtype, flip', CASES)
+def test_preprocessing_batch(dtype, flip):
+    planes, expected = case(dtype, flip)
+    assert preprocessing.normalize(planes, flip=flip).tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize('dtype, flip', CASES)
+def test_inference_page_reader(dtype, flip):
+    planes, expected = case(dtype, flip)
+    for plane, image in zip(planes, expected):
+        # utils.normalize_image_into on the flipped page view
+        out = np.empty(plane.shape, dtype=np.uint8)
+        scratch = np.empty(plane.shape, dtype=np.float32)
+        normalize_image_into(plane[::-1] if flip else plane, out, scratch)
+        assert out.tobytes() == image.tobytes()
+
+        # PageReader: normalised straight into a strided float32 or uint8 model-input slot
+        for input_dtype in (np.uint8, np.float32):
+            arena = np.zeros((2, *plane.shape, 1), dtype=input_dtype)
+            preprocessing.normalize_into(plane, arena[1, ..., 0], scratch, flip=flip)
+            assert arena[1, ..., 0].astype(np.uint8).tobytes() == image.tobytes()
+
+
+@pytest.mark.parametrize('dtype, flip', CASES)
+def test_dataset_creator(dtype, flip):
+    pytest.importorskip('tqdm')
+    sys.path.insert(0, DATASET_CREATOR_DIR)
+    from dataset import crop_windows, normalize_images_to_255
+
+    planes, expected = case(dtype, flip)
+    planes = planes[:, ::-1] if flip else planes
+    assert normalize_images_to_255(planes).tobytes() == expected.tobytes()
+
+    # Strips are stored flipped; a strip of one window crops to the whole plane
+    assert crop_windows(planes, np.zeros(len(planes), dtype=int), width=planes.shape[2]).tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize('dtype, flip', CASES)
+def test_dataset_creator_processor(dtype, flip):
+    for module in ('tqdm', 'pandas', 'your'):
+        pytest.importorskip(module)
+    sys.path.insert(0, DATASET_CREATOR_DIR)
+    from processor import DMTimeDataSetCreator
+
+    planes, expected = case(dtype, flip)
+    planes = planes[:, ::-1] if flip else planes
+    assert DMTimeDataSetCreator.normalize_images_to_255(planes).tobytes() == expected.tobytes()
+    for plane, image in zip(planes, expected):
+        assert DMTimeDataSetCreator.normalize_image_to_255(plane).tobytes() == image.tobytes()
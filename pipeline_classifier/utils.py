@@ -3,7 +3,8 @@ import json
 import time
 import pickle
 import subprocess
-import numpy as np
+
+from preprocessing import normalize, normalize_into
 
 # Function to run a command
 def run_command(command, wait=True):
@@ -61,11 +62,41 @@ def kill_buffer(image_path, key):
 
     return None
 
+def get_buffer_fill(image_path, key):
+    """
+    Returns (full blocks, total blocks) of the data ring buffer with the
+    given key, or None if the buffer could not be queried.
+
+    The values are read from `dada_dbmetric`, which prints the comma-separated
+    counters "total,full,clear,written,read" of the data blocks.
+    """
+    command = f'singularity exec {image_path} dada_dbmetric -k {key}'
+    result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    for line in reversed(result.stdout.decode().splitlines()):
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) >= 2 and fields[0].isdigit() and fields[1].isdigit():
+            return int(fields[1]), int(fields[0])
+
+    return None
+
 def load_config(file_path):
     with open(file_path, 'r') as file:
         config = json.load(file)
     return config
 
+def spectra_per_page(config, nbits, nchans):
+    """
+    Number of filterbank spectra that make up one DM-time page.
+
+    Every block of `input_buffer_size` bytes of the input ring buffer holds
+    `input_buffer_size * 8 / (nbits * nchans)` spectra and is dedispersed
+    into one page. The optional `spectra_per_page` key overrides this.
+    """
+    if config.get("spectra_per_page"):
+        return config["spectra_per_page"]
+    return config["input_buffer_size"] * 8 // (nbits * nchans)
+
 def load_time_keeper(filename):
     with open(filename, 'rb') as dump_file:
         time_keeper = pickle.load(dump_file)
@@ -82,9 +113,18 @@ def save_time_keeper(filename, time_keeper):
 
 
 def normalize_image_to_255(data):
-    normalized_data = (data - np.min(data)) / (np.max(data) - np.min(data))
-    scaled_data = (normalized_data * 255).astype(np.uint8)
-    return scaled_data
+    """
+    Normalises `data` to the 0-255 range as uint8, see `preprocessing.normalize`.
+    """
+    return normalize(data)
+
+
+def normalize_image_into(data, out, scratch):
+    """
+    Normalises `data` to the 0-255 range into the preallocated `out` array,
+    see `preprocessing.normalize_into`.
+    """
+    return normalize_into(data, out, scratch)
 
 
 def convert_to_milliseconds(data):
@@ -0,0 +1,96 @@
+import os
+import sys
+import numpy as np
+import tensorflow as tf
+
+DATASET_CREATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DM_time_dataset_creator')
+PIPELINE_CLASSIFIER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline_classifier')
+sys.path.insert(0, DATASET_CREATOR_DIR)
+sys.path.insert(0, PIPELINE_CLASSIFIER_DIR)
+from dataset import ShardedDataset  # noqa: E402
+from preprocessing import downsample  # noqa: E402
+
+
+class MemmapSource:
+    """
+    Memory-mapped flat `.npy` dataset with the batch interface of `ShardedDataset`.
+
+    Only the samples of the requested batches are read from disk.
+    """
+    def __init__(self, path):
+        self.data = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def sample_shape(self):
+        return self.data.shape[1:]
+
+    def get_batch(self, positions):
+        """
+        Read a batch of samples.
+
+        Args:
+            positions (array-like): Positions of the samples in the file.
+
+        Returns:
+            numpy.ndarray: uint8 array of shape (len(positions), *sample_shape).
+        """
+        positions = np.asarray(positions)
+
+        # Read in storage order for locality, then put the samples back in place
+        order = np.argsort(positions)
+        rows = np.empty_like(order)
+        rows[order] = np.arange(len(order))
+        return np.asarray(self.data[positions[order]])[rows]
+
+
+def make_dataset(source, positions, labels, batch_size=32, shuffle=True, shuffle_buffer=None,
+                 seed=None, num_parallel_calls=tf.data.AUTOTUNE, resolution=None):
+    """
+    Build a streaming `tf.data` pipeline over a memory-mapped dataset.
+
+    Only the positions of the samples are shuffled and batched; the samples of
+    every batch are then read from `source` by parallel map calls, so the data
+    is never copied as a whole and stays uint8 until it reaches a batch. The
+    batches are cast to float32 with a channel axis and prefetched, so reading
+    overlaps with training. With `resolution`, every batch is block-averaged
+    to that resolution right after it is read (see `downsample`).
+
+    Args:
+        source (ShardedDataset or MemmapSource): Dataset with a `get_batch(positions)` method.
+        positions (numpy.ndarray): Positions of the samples of this split in `source`.
+        labels (numpy.ndarray): Encoded labels of the samples of this split.
+        batch_size (int): Number of samples per batch.
+        shuffle (bool): Reshuffle the samples every epoch.
+        shuffle_buffer (int, optional): Shuffle buffer size; all positions of the split by default,
+            which is cheap because only the positions are buffered.
+        seed (int, optional): Seed of the shuffling.
+        num_parallel_calls (int): Number of batches read in parallel.
+        resolution (int, optional): Resolution the samples are downsampled to; the stored one by default.
+
+    Returns:
+        tf.data.Dataset: Batches of (float32 images of shape (batch, *sample_shape, 1), int labels).
+    """
+    sample_shape = tuple(source.sample_shape)
+    get_batch = source.get_batch
+    if resolution is not None:
+        sample_shape = (resolution, resolution)
+        get_batch = lambda batch_positions: downsample(source.get_batch(batch_positions), resolution)
+
+    def read_batch(batch_positions, batch_labels):
+        images = tf.numpy_function(get_batch, [batch_positions], tf.uint8)
+        images.set_shape((None, *sample_shape))
+        return images, batch_labels
+
+    def to_model_input(images, batch_labels):
+        return tf.cast(images, tf.float32)[..., tf.newaxis], batch_labels
+
+    dataset = tf.data.Dataset.from_tensor_slices((np.asarray(positions, dtype=np.int64), np.asarray(labels)))
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer or len(positions), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(read_batch, num_parallel_calls=num_parallel_calls, deterministic=not shuffle)
+    dataset = dataset.map(to_model_input, num_parallel_calls=num_parallel_calls)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+from sklearn.model_selection import train_test_split
+from training import load_config, load_source
+from data_pipeline import downsample
+
+
+# Function to read a batch of uint8 images at the model resolution
+def batch_reader(source, downsample_to):
+    if downsample_to is None:
+        return source.get_batch
+    return lambda positions: downsample(source.get_batch(positions), downsample_to)
+
+
+# Function to build the calibration set for post-training quantization
+def representative_dataset(get_batch, indices):
+    def generator():
+        for idx in indices:
+            yield [get_batch([idx])[..., np.newaxis].astype(np.float32)]
+    return generator
+
+
+# Function to convert a trained Keras model into an int8 TFLite engine
+def quantize(model, get_batch, calibration_indices):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(get_batch, calibration_indices)
+
+    # Integer-only kernels; images enter as uint8 pixels, probabilities leave as float32
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.uint8
+    converter.inference_output_type = tf.float32
+    return converter.convert()
+
+
+# Function to run a TFLite interpreter on a batch of uint8 images
+def run_tflite(interpreter, images):
+    input_detail = interpreter.get_input_details()[0]
+    output_detail = interpreter.get_output_details()[0]
+
+    if tuple(input_detail['shape']) != images.shape:
+        interpreter.resize_tensor_input(input_detail['index'], images.shape)
+        interpreter.allocate_tensors()
+
+    interpreter.set_tensor(input_detail['index'], images.astype(input_detail['dtype'], copy=False))
+    interpreter.invoke()
+    return interpreter.get_tensor(output_detail['index'])
+
+
+# Function to compare float and quantized predictions on the held-out set
+def parity_report(model, interpreter, get_batch, labels, indices, batch_size):
+    float_predictions = []
+    int8_predictions = []
+    max_probability_difference = 0.0
+    float_time = 0.0
+    int8_time = 0.0
+
+    for start in range(0, len(indices), batch_size):
+        batch_indices = indices[start:start + batch_size]
+        images = np.ascontiguousarray(get_batch(batch_indices)[..., np.newaxis])
+
+        t0 = time.perf_counter()
+        float_probabilities = np.asarray(model(images, training=False))
+        t1 = time.perf_counter()
+        int8_probabilities = run_tflite(interpreter, images)
+        t2 = time.perf_counter()
+
+        float_time += t1 - t0
+        int8_time += t2 - t1
+        max_probability_difference = max(
+            max_probability_difference,
+            float(np.max(np.abs(float_probabilities - int8_probabilities)))
+        )
+        float_predictions.append(np.argmax(float_probabilities, axis=-1))
+        int8_predictions.append(np.argmax(int8_probabilities, axis=-1))
+
+    float_predictions = np.concatenate(float_predictions)
+    int8_predictions = np.concatenate(int8_predictions)
+    truth = labels[indices]
+
+    def confusion(predictions):
+        # Rows are true classes (0 - Artefact, 1 - Pulse), columns are predicted classes
+        return [[int(np.sum((truth == t) & (predictions == p))) for p in (0, 1)] for t in (0, 1)]
+
+    return {
+        'held_out_samples': int(len(indices)),
+        'float_accuracy': float(np.mean(float_predictions == truth)),
+        'int8_accuracy': float(np.mean(int8_predictions == truth)),
+        'agreement': float(np.mean(float_predictions == int8_predictions)),
+        'max_probability_difference': max_probability_difference,
+        'float_confusion': confusion(float_predictions),
+        'int8_confusion': confusion(int8_predictions),
+        'float_ms_per_image': 1000 * float_time / len(indices),
+        'int8_ms_per_image': 1000 * int8_time / len(indices),
+        'speedup': float_time / int8_time if int8_time > 0 else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization of a trained classifier')
+    parser.add_argument('config', type=str, help='Training config file describing the dataset')
+    parser.add_argument('-m', '--model', type=str, required=True, help='Trained Keras .h5 model')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Output .tflite file')
+    parser.add_argument('--calibration-samples', type=int, default=512,
+                        help='Number of training samples used to calibrate the quantization ranges')
+    parser.add_argument('--parity-samples', type=int, default=None,
+                        help='Limit the number of held-out samples used for the parity report')
+    parser.add_argument('--batch-size', type=int, default=64, help='Batch size for the parity report')
+    parser.add_argument('--threads', type=int, default=None, help='Threads for the TFLite interpreter')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    resolution = config["resolution"]
+    output = args.output or f'{os.path.splitext(args.model)[0]}_int8.tflite'
+
+    # Open the dataset like training.py, only the sampled images are read and downsampled
+    source, labels, downsample_to = load_source(config, resolution)
+    get_batch = batch_reader(source, downsample_to)
+
+    # Same split as training.py, so the held-out set is the validation set
+    train_indices, held_out_indices = train_test_split(np.arange(len(source)), test_size=0.2, random_state=42)
+
+    rng = np.random.default_rng(42)
+    calibration_indices = np.sort(rng.choice(train_indices, size=min(args.calibration_samples, len(train_indices)), replace=False))
+    if args.parity_samples is not None:
+        held_out_indices = held_out_indices[:args.parity_samples]
+    held_out_indices = np.sort(held_out_indices)
+
+    model = load_model(args.model)
+
+    print(f'Calibrating on {len(calibration_indices)} samples')
+    tflite_model = quantize(model, get_batch, calibration_indices)
+    with open(output, 'wb') as file:
+        file.write(tflite_model)
+    print(f'Quantized model saved to {output}')
+
+    interpreter = tf.lite.Interpreter(model_path=output, num_threads=args.threads)
+    interpreter.allocate_tensors()
+
+    report = parity_report(model, interpreter, get_batch, labels, held_out_indices, args.batch_size)
+    report['model'] = args.model
+    report['quantized_model'] = output
+    report['calibration_samples'] = int(len(calibration_indices))
+
+    report_path = f'{os.path.splitext(output)[0]}_parity.json'
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    print(json.dumps(report, indent=4))
+    print(f'Parity report saved to {report_path}')
+
+
+if __name__ == "__main__":
+    main()
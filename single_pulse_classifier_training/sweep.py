@@ -0,0 +1,123 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+import subprocess
+
+RESOLUTIONS = (256, 128, 64, 32)
+RESULT_COLUMNS = ('model', 'resolution', 'status', 'epochs', 'train_accuracy', 'best_val_accuracy', 'val_accuracy',
+                  'val_loss', 'training_time_s', 'latency_single_image_ms', 'latency_per_image_in_batch_ms', 'cores')
+
+
+def partition_cores(cores, n_slots):
+    """
+    Splits the available cores into `n_slots` disjoint, nearly equal groups.
+    """
+    cores = sorted(cores)
+    size, extra = divmod(len(cores), n_slots)
+    groups, start = [], 0
+    for slot in range(n_slots):
+        stop = start + size + (1 if slot < extra else 0)
+        groups.append(cores[start:stop])
+        start = stop
+    return groups
+
+
+def start_job(args, model_name, resolution, cores, output_dir):
+    """
+    Starts `training.py` for one model/resolution combination, pinned to
+    `cores` and with as many TensorFlow threads as it has cores.
+    """
+    name = f'{model_name}_{resolution}'
+    results_path = os.path.join(output_dir, f'{name}.json')
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'training.py'), args.config,
+        '--model-name', model_name, '--resolution', str(resolution),
+        '--intra-op-threads', str(len(cores)), '--inter-op-threads', str(args.inter_op_threads),
+        '--results', results_path
+    ]
+
+    # Keep the numerical libraries of the job on its own cores
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), OPENBLAS_NUM_THREADS=str(len(cores)),
+               MKL_NUM_THREADS=str(len(cores)))
+    log_file = open(os.path.join(output_dir, f'{name}.log'), 'w')
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=env,
+                               preexec_fn=lambda: os.sched_setaffinity(0, cores))
+    return {'model': model_name, 'resolution': resolution, 'cores': cores, 'process': process,
+            'log_file': log_file, 'results_path': results_path}
+
+
+def collect_result(job):
+    job['log_file'].close()
+    result = {'model': job['model'], 'resolution': job['resolution'], 'cores': len(job['cores'])}
+    if job['process'].returncode == 0 and os.path.exists(job['results_path']):
+        with open(job['results_path'], 'r') as file:
+            result.update(json.load(file))
+        result['status'] = 'ok'
+    else:
+        result['status'] = f'failed ({job["process"].returncode})'
+    return result
+
+
+def print_table(results):
+    columns = ('model', 'resolution', 'status', 'best_val_accuracy', 'val_accuracy', 'training_time_s',
+               'latency_single_image_ms', 'latency_per_image_in_batch_ms')
+    rows = [[f'{result[column]:.4f}' if isinstance(result.get(column), float) else str(result.get(column, ''))
+             for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[idx]) for row in rows)) for idx, column in enumerate(columns)]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)).rstrip())
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train all model/resolution combinations in parallel on one node')
+    parser.add_argument('config', type=str, help='Training config file shared by all jobs')
+    parser.add_argument('--models', nargs='+', default=None, help='Models from models_htable (default: all)')
+    parser.add_argument('--resolutions', nargs='+', type=int, default=list(RESOLUTIONS))
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of jobs trained at the same time')
+    parser.add_argument('--inter-op-threads', type=int, default=2, help='TensorFlow inter-op threads per job')
+    parser.add_argument('--output-dir', type=str, default='sweep/', help='Directory of the job logs and results')
+    args = parser.parse_args()
+
+    if args.models is None:
+        from training_models import models_htable
+        args.models = list(models_htable)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    pending = list(itertools.product(args.models, args.resolutions))
+    n_slots = max(1, min(args.jobs, len(pending), len(os.sched_getaffinity(0))))
+    free_slots = partition_cores(os.sched_getaffinity(0), n_slots)
+    print(f'{len(pending)} jobs, {n_slots} at a time on {[len(slot) for slot in free_slots]} cores')
+
+    running, results = [], []
+    while pending or running:
+        # Fill the free core groups with pending jobs
+        while pending and free_slots:
+            model_name, resolution = pending.pop(0)
+            running.append(start_job(args, model_name, resolution, free_slots.pop(0), args.output_dir))
+
+        time.sleep(1)
+        for job in [job for job in running if job['process'].poll() is not None]:
+            running.remove(job)
+            free_slots.append(job['cores'])
+            results.append(collect_result(job))
+            print(f"Finished {job['model']} {job['resolution']}x{job['resolution']}: {results[-1]['status']}")
+
+    # One table of all jobs
+    results.sort(key=lambda result: (result['model'], -result['resolution']))
+    table_path = os.path.join(args.output_dir, 'sweep_results.csv')
+    with open(table_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=RESULT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+    print_table(results)
+    print(f'Results saved to {table_path}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
-import sys
 import os
 import json
+import time
+import argparse
 import tensorflow as tf
 from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping
 from tensorflow.keras.optimizers import Adam
@@ -9,6 +10,7 @@ from sklearn.model_selection import train_test_split
 import numpy as np
 import matplotlib.pyplot as plt
 from training_models import models_htable
+from data_pipeline import MemmapSource, ShardedDataset, make_dataset
 
 
 # Function to load the configuration file
@@ -29,6 +31,30 @@ def get_filename(config, resolution):
     return os.path.join(config["path_to_files"], filename)
 
 
+# Function to open the dataset of the config as a batch source with its labels
+def load_source(config, resolution):
+    """
+    Opens the dataset named in the config without loading it.
+
+    Returns `(source, labels, downsample_to)`: a `ShardedDataset` for
+    `dataset_manifest` or else a `MemmapSource` (the 256x256 file with
+    `derive_resolutions`), the encoded labels, and the resolution the stored
+    samples have to be downsampled to, or None if they already have it.
+    """
+    if "dataset_manifest" in config:
+        # Sharded dataset; shifted windows are cropped from the stored strips batch by batch
+        source = ShardedDataset(os.path.join(config["path_to_files"], config["dataset_manifest"]))
+        labels = label_encoding(source.labels)
+    else:
+        # Dynamically select the data file based on resolution, or derive it from the 256x256 file
+        stored_resolution = 256 if config.get("derive_resolutions", False) else resolution
+        source = MemmapSource(get_filename(config, stored_resolution))
+        labels = label_encoding(np.load(os.path.join(config["path_to_files"], config["labels"])))
+
+    downsample_to = resolution if tuple(source.sample_shape) != (resolution, resolution) else None
+    return source, labels, downsample_to
+
+
 # Function to set up callbacks for model training
 def get_callbacks(config, resolution, model_name):
     checkpoint_path = os.path.join(
@@ -70,29 +96,58 @@ def label_encoding(labels):
     return np.array([map_dict[i] for i in labels])
 
 
+# Function to measure the CPU inference latency of a trained model
+def measure_latency(model, images, repeats=10):
+    """
+    Returns the mean latency in seconds of classifying one image alone and
+    of classifying `images` as one batch, after a warm-up call of each.
+    """
+    latencies = []
+    for batch in (images[:1], images):
+        model(batch, training=False)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(batch, training=False)
+        latencies.append((time.perf_counter() - start) / repeats)
+    return latencies
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Train a single-pulse classifier')
+    parser.add_argument('config', type=str, help='Training config file')
+    parser.add_argument('--model-name', type=str, default=None, help='Overrides model_name of the config')
+    parser.add_argument('--resolution', type=int, default=None, help='Overrides resolution of the config')
+    parser.add_argument('--intra-op-threads', type=int, default=0, help='TensorFlow intra-op threads (0: all cores)')
+    parser.add_argument('--inter-op-threads', type=int, default=0, help='TensorFlow inter-op threads (0: automatic)')
+    parser.add_argument('--results', type=str, default=None, help='Write the final metrics to this JSON file')
+    args = parser.parse_args()
+
+    # Threads have to be set before TensorFlow runs any operation
+    tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+
     # Load configuration file
-    config_path = sys.argv[1]
-    config = load_config(config_path)
+    config = load_config(args.config)
 
     # Extract parameters from the configuration
-    resolution = config["resolution"]
-    model_name = config["model_name"]
-
-    # Dynamically select the data file based on resolution
-    filename = get_filename(config, resolution)
-    labels_file = os.path.join(config["path_to_files"], config["labels"])
+    resolution = args.resolution or config["resolution"]
+    model_name = args.model_name or config["model_name"]
 
-    # Load the data and labels
-    data = np.load(filename)
-    labels = np.load(labels_file)
+    # Memory-mapped dataset, from a manifest or a flat file
+    source, labels, downsample_to = load_source(config, resolution)
 
-    # Add an additional dimension to the data
-    data = data[..., tf.newaxis]
-    labels = label_encoding(labels)
+    # Split the positions into training and validation sets; the data itself is never copied
+    train_idx, val_idx = train_test_split(np.arange(len(source)), test_size=0.2, random_state=42)
 
-    # Split the dataset into training and validation sets
-    x_train, x_val, y_train, y_val = train_test_split(data, labels, test_size=0.2, random_state=42)
+    # Stream the batches from the memory-mapped data
+    # Lower resolutions are block-averaged from the stored samples batch by batch
+    pipeline_args = dict(
+        batch_size=config.get("batch_size", 32),
+        num_parallel_calls=config.get("parallel_reads", tf.data.AUTOTUNE),
+        resolution=downsample_to
+    )
+    train_data = make_dataset(source, train_idx, labels[train_idx], shuffle_buffer=config.get("shuffle_buffer"), **pipeline_args)
+    validation_data = make_dataset(source, val_idx, labels[val_idx], shuffle=False, **pipeline_args)
 
     # Initialize the model
     model = models_htable[model_name](resolution)
@@ -105,13 +160,14 @@ def main():
                   metrics=['accuracy'])
 
     # Train the model
+    training_start = time.perf_counter()
     history = model.fit(
-        x_train,
-        y_train,
+        train_data,
         epochs=config["num_epochs"],
-        validation_data=(x_val, y_val),
+        validation_data=validation_data,
         callbacks=callbacks
     )
+    training_time = time.perf_counter() - training_start
 
     # Plot training and validation loss and accuracy
     plt.clf()
@@ -147,9 +203,31 @@ def main():
     )
 
     # Evaluate the model on the validation set
-    test_loss, test_acc = model.evaluate(x_val, y_val, verbose=2)
+    test_loss, test_acc = model.evaluate(validation_data, verbose=2)
     print(f'Test Accuracy: {test_acc}')
 
+    if args.results:
+        # Final metrics, training time and inference latency on one validation batch
+        images, _ = next(iter(validation_data))
+        single_latency, batch_latency = measure_latency(model, images)
+        results = {
+            'model': model_name,
+            'resolution': resolution,
+            'epochs': len(history.history['loss']),
+            'train_accuracy': float(history.history['accuracy'][-1]),
+            'best_val_accuracy': float(max(history.history['val_accuracy'])),
+            'val_accuracy': float(test_acc),
+            'val_loss': float(test_loss),
+            'training_time_s': training_time,
+            'latency_single_image_ms': single_latency * 1000,
+            'latency_per_image_in_batch_ms': batch_latency * 1000 / len(images),
+            'batch_size': int(len(images)),
+            'intra_op_threads': args.intra_op_threads,
+            'inter_op_threads': args.inter_op_threads
+        }
+        with open(args.results, 'w') as results_file:
+            json.dump(results, results_file, indent=4)
+
 
 if __name__ == "__main__":
     main()